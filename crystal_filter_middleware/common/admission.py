@@ -0,0 +1,291 @@
+'''
+Per-tenant admission control for filter execution.
+
+Budgets are read from the controller's Redis, next to the filter policies,
+from the hash 'admission:<account>':
+
+    max_concurrency            concurrent requests per node
+    max_bytes_per_sec          body bytes per second per node
+    cluster_max_concurrency    concurrent requests in the whole cluster
+    <filter>:max_concurrency   concurrent executions of a filter per node
+
+Missing fields fall back to the admission_* defaults of the configuration,
+where 0 means unlimited. Requests over budget wait in a queue for at most
+admission_queue_timeout seconds and are then rejected.
+
+Node budgets are split evenly among the workers of the server (the
+'workers' option of the server configuration), so that each worker
+enforces its share without any coordination on the request path. The
+cluster budget is a sorted set of the admitted requests in Redis, scored by
+admission time, so that entries leaked by a killed worker expire after
+admission_active_ttl seconds.
+'''
+from eventlet import sleep
+from eventlet import Timeout
+from eventlet.event import Event
+import multiprocessing
+import redis
+from crystal_filter_middleware.common.utils import get_redis
+import time
+import uuid
+
+ACTIVE_PREFIX = 'admission:active:'
+
+
+class AdmissionRejected(Exception):
+    pass
+
+
+def _get_workers(conf):
+    workers = str(conf.get('workers', 1)).strip().lower()
+    if workers == 'auto':
+        return multiprocessing.cpu_count()
+    return max(int(workers), 1)
+
+
+class _TokenBucket(object):
+
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.tokens = self.rate
+        self.last = time.time()
+
+    def consume(self, nbytes):
+        """
+        :return: seconds to wait to respect the rate
+        """
+        now = time.time()
+        self.tokens = min(self.rate,
+                          self.tokens + (now - self.last) * self.rate)
+        self.last = now
+        self.tokens -= nbytes
+        if self.tokens >= 0:
+            return 0
+        return -self.tokens / self.rate
+
+
+class Ticket(object):
+    """
+    Admission granted to a request (or to a filter within a request)
+    """
+
+    def __init__(self, key, account, cluster):
+        self.key = key
+        self.account = account
+        # Member of the cluster set, if admitted there
+        self.cluster = cluster
+        self.released = False
+
+
+class AdmissionController(object):
+
+    def __init__(self, conf, logger):
+        self.logger = logger
+        self.redis = get_redis(conf)
+        self.defaults = {
+            'max_concurrency': int(conf.get('admission_max_concurrency', 0)),
+            'max_bytes_per_sec': int(
+                conf.get('admission_max_bytes_per_sec', 0)),
+            'cluster_max_concurrency': int(
+                conf.get('admission_cluster_max_concurrency', 0))}
+        self.queue_timeout = float(conf.get('admission_queue_timeout', 0))
+        self.policy_ttl = float(conf.get('admission_policy_ttl', 30))
+        self.active_ttl = int(conf.get('admission_active_ttl', 3600))
+        self.workers = _get_workers(conf)
+
+        self.policies = dict()
+        self.active = dict()
+        self.waiters = dict()
+        self.buckets = dict()
+
+    def _get_policy(self, account):
+        now = time.time()
+        cached = self.policies.get(account)
+        if cached and now - cached[0] < self.policy_ttl:
+            return cached[1]
+        try:
+            policy = self.redis.hgetall('admission:' + account)
+        except redis.RedisError:
+            self.logger.error('Unable to read the admission policy of %s',
+                              account)
+            policy = cached[1] if cached else dict()
+        self.policies[account] = (now, policy)
+        return policy
+
+    def _limit(self, account, name, filter_name=None):
+        policy = self._get_policy(account)
+        if filter_name:
+            return int(policy.get(filter_name + ':' + name, 0))
+        return int(policy.get(name, self.defaults[name]))
+
+    def _worker_limit(self, account, name, filter_name=None):
+        """
+        Share of this worker in the node budget (0 means unlimited)
+        """
+        limit = self._limit(account, name, filter_name)
+        if not limit:
+            return 0
+        return max(limit // self.workers, 1)
+
+    def _wait_slot(self, key, limit):
+        if self.active.get(key, 0) < limit:
+            return
+        if self.queue_timeout <= 0:
+            raise AdmissionRejected(key)
+
+        deadline = time.time() + self.queue_timeout
+        while self.active.get(key, 0) >= limit:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise AdmissionRejected(key)
+            event = Event()
+            self.waiters.setdefault(key, []).append(event)
+            try:
+                with Timeout(remaining, False):
+                    event.wait()
+            finally:
+                if event in self.waiters.get(key, ()):
+                    self.waiters[key].remove(event)
+
+    def _acquire_cluster(self, account):
+        """
+        :return: the member of the request in the cluster set, or None if
+                 there is no cluster budget (or Redis is unavailable)
+        """
+        limit = self._limit(account, 'cluster_max_concurrency')
+        if not limit:
+            return None
+        key = ACTIVE_PREFIX + account
+        member = uuid.uuid4().hex
+        deadline = time.time() + self.queue_timeout
+        while True:
+            try:
+                now = time.time()
+                pipe = self.redis.pipeline()
+                pipe.zremrangebyscore(key, '-inf', now - self.active_ttl)
+                pipe.execute_command('ZADD', key, now, member)
+                pipe.zcard(key)
+                pipe.expire(key, self.active_ttl)
+                active = pipe.execute()[2]
+                if active <= limit:
+                    return member
+                self.redis.zrem(key, member)
+            except redis.RedisError:
+                # The node budgets still apply
+                return None
+            if time.time() >= deadline:
+                raise AdmissionRejected(account)
+            sleep(0.05)
+
+    def acquire(self, account, filter_name=None):
+        """
+        Admits a request of account, or the execution of one of its filters
+
+        :raises AdmissionRejected: if the budget is exhausted
+        """
+        key = account if not filter_name else account + '/' + filter_name
+        limit = self._worker_limit(account, 'max_concurrency', filter_name)
+        if limit:
+            self._wait_slot(key, limit)
+        # Reserved before the cluster budget, which yields on Redis I/O
+        self.active[key] = self.active.get(key, 0) + 1
+        cluster = None
+        if not filter_name:
+            try:
+                cluster = self._acquire_cluster(account)
+            except BaseException:
+                self._release_slot(key)
+                raise
+        return Ticket(key, account, cluster)
+
+    def _release_slot(self, key):
+        self.active[key] -= 1
+        if not self.active[key]:
+            del self.active[key]
+        waiters = self.waiters.get(key)
+        if waiters:
+            waiters.pop(0).send()
+        if not waiters and key in self.waiters:
+            del self.waiters[key]
+
+    def release(self, ticket):
+        if ticket.released:
+            return
+        ticket.released = True
+        self._release_slot(ticket.key)
+        if ticket.cluster:
+            try:
+                self.redis.zrem(ACTIVE_PREFIX + ticket.account, ticket.cluster)
+            except redis.RedisError:
+                pass
+
+    def throttle(self, account, nbytes):
+        """
+        Sleeps as needed to keep the account within its byte rate
+        """
+        rate = self._limit(account, 'max_bytes_per_sec')
+        if not rate:
+            return
+        rate = float(rate) / self.workers
+        bucket = self.buckets.get(account)
+        if bucket is None or bucket.rate != rate:
+            bucket = self.buckets[account] = _TokenBucket(rate)
+        wait = bucket.consume(nbytes)
+        if wait:
+            sleep(wait)
+
+
+class AdmittedInput(object):
+    """
+    Request body throttled to the byte budget of the account
+    """
+
+    def __init__(self, wsgi_input, controller, account):
+        self.wsgi_input = wsgi_input
+        self.controller = controller
+        self.account = account
+
+    def read(self, *args, **kwargs):
+        data = self.wsgi_input.read(*args, **kwargs)
+        self.controller.throttle(self.account, len(data))
+        return data
+
+    def readline(self, *args, **kwargs):
+        data = self.wsgi_input.readline(*args, **kwargs)
+        self.controller.throttle(self.account, len(data))
+        return data
+
+
+class AdmittedIter(object):
+    """
+    Response body throttled to the byte budget of the account (if throttle
+    is set). The tickets are released when the body has been sent (or the
+    client went away).
+    """
+
+    def __init__(self, app_iter, controller, account, tickets,
+                 throttle=True):
+        self.app_iter = app_iter
+        self.iterator = iter(app_iter)
+        self.controller = controller
+        self.account = account
+        self.tickets = tickets
+        self.throttle = throttle
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        chunk = next(self.iterator)
+        if self.throttle:
+            self.controller.throttle(self.account, len(chunk))
+        return chunk
+    __next__ = next
+
+    def close(self):
+        try:
+            if hasattr(self.app_iter, 'close'):
+                self.app_iter.close()
+        finally:
+            for ticket in self.tickets:
+                self.controller.release(ticket)
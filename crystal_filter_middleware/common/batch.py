@@ -0,0 +1,48 @@
+'''
+Policy resolution shared by the subrequests of a bulk operation.
+
+Bulk delete, bulk extract-archive and server-side copy fan out into many
+object subrequests that keep the transaction id of their parent request.
+The pipeline resolved for the first subrequest of an (account, container)
+is reused by the rest of the batch.
+'''
+from collections import OrderedDict
+import time
+
+
+class BatchPolicyCache(object):
+
+    def __init__(self, conf):
+        self.sources = set(x.strip() for x in
+                           conf.get('batch_sources', 'BD,EA,SSC').split(',')
+                           if x.strip())
+        self.ttl = float(conf.get('batch_cache_ttl', 30))
+        self.max_entries = int(conf.get('batch_cache_entries', 1000))
+        self.entries = OrderedDict()
+        self.hits = 0
+
+    def get_key(self, environ, account, container, method):
+        """
+        :return: the batch key of a bulk subrequest, or None if the request
+                 is not part of a bulk operation
+        """
+        trans_id = environ.get('swift.trans_id')
+        if not trans_id or environ.get('swift.source') not in self.sources:
+            return None
+        return (trans_id, account, container, method)
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if time.time() - entry[0] > self.ttl:
+            del self.entries[key]
+            return None
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key, value):
+        self.entries.pop(key, None)
+        self.entries[key] = (time.time(), value)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
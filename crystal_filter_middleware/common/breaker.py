@@ -0,0 +1,106 @@
+'''
+Circuit breaker for the calls to the controller's Redis, and the store of
+last-known-good pipelines served while the breaker is open.
+'''
+from collections import OrderedDict
+import time
+
+
+class CircuitOpen(Exception):
+    pass
+
+
+class CircuitBreaker(object):
+    """
+    Opens after failure_threshold consecutive failures (calls slower than
+    latency_threshold count as failures). While open, calls are rejected
+    without reaching Redis; after reset_timeout a single probe call is let
+    through (half-open) and its result closes or re-opens the breaker.
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold, latency_threshold, reset_timeout,
+                 logger=None):
+        self.failure_threshold = failure_threshold
+        self.latency_threshold = latency_threshold
+        self.reset_timeout = reset_timeout
+        self.logger = logger
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0
+
+    def _allow(self):
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN and \
+           time.time() - self.opened_at >= self.reset_timeout:
+            self.state = self.HALF_OPEN
+            return True
+        # Open, or half-open with the probe already in flight
+        return False
+
+    def _success(self):
+        if self.state != self.CLOSED and self.logger:
+            self.logger.info('Redis circuit breaker closed')
+        self.state = self.CLOSED
+        self.failures = 0
+
+    def _failure(self):
+        self.failures += 1
+        if self.state == self.HALF_OPEN or \
+           self.failures >= self.failure_threshold:
+            if self.state != self.OPEN and self.logger:
+                self.logger.error('Redis circuit breaker opened after %d '
+                                  'failures', self.failures)
+            self.state = self.OPEN
+            self.opened_at = time.time()
+
+    def call(self, func, *args):
+        """
+        :raises CircuitOpen: if the breaker does not allow the call
+        """
+        if not self._allow():
+            raise CircuitOpen()
+        start = time.time()
+        completed = False
+        try:
+            result = func(*args)
+            completed = True
+        finally:
+            if not completed:
+                # Also on GreenletExit or eventlet Timeout, so that a lost
+                # probe re-opens the breaker instead of leaving it half-open
+                self._failure()
+        if self.latency_threshold and \
+           time.time() - start > self.latency_threshold:
+            self._failure()
+        else:
+            self._success()
+        return result
+
+
+class LastKnownGood(object):
+    """
+    Bounded LRU of the last pipeline successfully read for each key
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+
+    def set(self, key, value):
+        self.entries.pop(key, None)
+        self.entries[key] = (time.time(), value)
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def get(self, key):
+        """
+        :return: (age in seconds, value) or None
+        """
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        return time.time() - entry[0], entry[1]
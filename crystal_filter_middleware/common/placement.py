@@ -0,0 +1,230 @@
+'''
+Adaptive proxy-vs-object placement of "movable" filters.
+
+Every filter marked as movable is metered where it runs: bytes that enter
+the filter, bytes that leave it and the time spent inside it. The totals
+are periodically flushed to the controller's Redis, so that every proxy of
+the cluster can decide where a movable filter should run in order to
+minimize the proxy-to-storage network traffic:
+
+* GET: data flows from the object server to the proxy. A filter that
+  shrinks data runs on the object server, one that expands data runs on
+  the proxy.
+* PUT: data flows from the proxy to the object server, so the decision is
+  the opposite one.
+
+Filters too expensive in CPU for the proxies are always kept on the object
+servers.
+'''
+import time
+import redis
+from crystal_filter_middleware.common.utils import get_redis
+
+STATS_PREFIX = 'filter_stats:'
+
+
+class FilterStatsRecorder(object):
+    """
+    Accumulates per-filter measurements in memory and flushes them to Redis
+    at most once every flush interval.
+    """
+
+    def __init__(self, conf, logger=None):
+        self.redis = get_redis(conf)
+        self.logger = logger
+        self.flush_interval = float(conf.get('placement_flush_interval', 10))
+        self.pending = dict()
+        self.last_flush = time.time()
+
+    def record(self, name, method, bytes_in, bytes_out, elapsed):
+        key = STATS_PREFIX + name
+        stats = self.pending.setdefault(key, dict())
+        for field, value in ((method + '_bytes_in', bytes_in),
+                             (method + '_bytes_out', bytes_out),
+                             (method + '_time', elapsed),
+                             (method + '_samples', 1)):
+            stats[field] = stats.get(field, 0) + value
+
+        if time.time() - self.last_flush > self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        pending, self.pending = self.pending, dict()
+        self.last_flush = time.time()
+        if not pending:
+            return
+        try:
+            pipe = self.redis.pipeline(transaction=False)
+            for key, stats in pending.items():
+                for field, value in stats.items():
+                    pipe.hincrbyfloat(key, field, value)
+            pipe.execute()
+        except redis.RedisError:
+            # Measurements must never fail the request: retry next time
+            if self.logger:
+                self.logger.error('Unable to flush the filter statistics')
+            for key, stats in pending.items():
+                current = self.pending.setdefault(key, dict())
+                for field, value in stats.items():
+                    current[field] = current.get(field, 0) + value
+
+
+class PlacementEngine(object):
+    """
+    Decides the execution server of movable filters from the measured
+    input/output byte ratios and time per byte.
+    """
+
+    def __init__(self, conf):
+        self.redis = get_redis(conf)
+        self.refresh_interval = float(
+            conf.get('placement_refresh_interval', 30))
+        self.min_samples = int(conf.get('placement_min_samples', 20))
+        # Hysteresis: ratios within [1 - margin, 1 + margin] are neutral
+        self.margin = float(conf.get('placement_ratio_margin', 0.1))
+        self.proxy_max_time_per_mb = float(
+            conf.get('placement_proxy_max_time_per_mb', 0.05))
+        self.cache = dict()
+
+    def _get_stats(self, name):
+        now = time.time()
+        cached = self.cache.get(name)
+        if cached and now - cached[0] < self.refresh_interval:
+            return cached[1]
+        try:
+            stats = self.redis.hgetall(STATS_PREFIX + name)
+        except redis.RedisError:
+            stats = cached[1] if cached else dict()
+        self.cache[name] = (now, stats)
+        return stats
+
+    def place(self, filter_metadata, method):
+        """
+        :param filter_metadata: filter metadata dict stored in Redis
+        :param method: lowercase request method
+        :return: 'proxy' or 'object'
+        """
+        default = filter_metadata['execution_server']
+        if method not in ('get', 'put'):
+            return default
+
+        stats = self._get_stats(filter_metadata['filter_name'])
+        samples = float(stats.get(method + '_samples', 0))
+        bytes_in = float(stats.get(method + '_bytes_in', 0))
+        bytes_out = float(stats.get(method + '_bytes_out', 0))
+        if samples < self.min_samples or bytes_in <= 0:
+            return default
+
+        elapsed = float(stats.get(method + '_time', 0))
+        if elapsed / bytes_in * 1048576 > self.proxy_max_time_per_mb:
+            return 'object'
+
+        ratio = bytes_out / bytes_in
+        if ratio < 1 - self.margin:
+            return 'object' if method == 'get' else 'proxy'
+        if ratio > 1 + self.margin:
+            return 'proxy' if method == 'get' else 'object'
+        return default
+
+
+class Measurement(object):
+    """
+    Byte counters and timers at both sides (outer/inner) of a filter
+    """
+
+    def __init__(self, name, method, recorder):
+        self.name = name
+        self.method = method
+        self.recorder = recorder
+        self.bytes = {'outer': 0, 'inner': 0}
+        self.time = {'outer': 0.0, 'inner': 0.0}
+        self.recorded = False
+
+    def add(self, side, nbytes, elapsed):
+        self.bytes[side] += nbytes
+        self.time[side] += elapsed
+
+    def record(self):
+        if self.recorded:
+            return
+        self.recorded = True
+        if self.method == 'get':
+            # Response body: produced by the inner app, leaves by the outer
+            bytes_in, bytes_out = self.bytes['inner'], self.bytes['outer']
+            elapsed = self.time['outer'] - self.time['inner']
+        else:
+            # Request body: enters by the outer side, leaves by the inner
+            bytes_in, bytes_out = self.bytes['outer'], self.bytes['inner']
+            elapsed = self.time['inner'] - self.time['outer']
+        if bytes_in:
+            self.recorder.record(self.name, self.method, bytes_in,
+                                 bytes_out, max(elapsed, 0.0))
+
+
+class _MeteredInput(object):
+
+    def __init__(self, wsgi_input, measurement, side):
+        self.wsgi_input = wsgi_input
+        self.measurement = measurement
+        self.side = side
+
+    def read(self, *args, **kwargs):
+        start = time.time()
+        data = self.wsgi_input.read(*args, **kwargs)
+        self.measurement.add(self.side, len(data), time.time() - start)
+        return data
+
+    def readline(self, *args, **kwargs):
+        start = time.time()
+        data = self.wsgi_input.readline(*args, **kwargs)
+        self.measurement.add(self.side, len(data), time.time() - start)
+        return data
+
+
+class _MeteredIter(object):
+
+    def __init__(self, app_iter, measurement, side):
+        self.app_iter = app_iter
+        self.iterator = iter(app_iter)
+        self.measurement = measurement
+        self.side = side
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        start = time.time()
+        chunk = next(self.iterator)
+        self.measurement.add(self.side, len(chunk), time.time() - start)
+        return chunk
+    __next__ = next
+
+    def close(self):
+        if hasattr(self.app_iter, 'close'):
+            self.app_iter.close()
+        if self.side == 'outer':
+            self.measurement.record()
+
+
+class MeterPoint(object):
+    """
+    WSGI middleware placed at one side of a filter to meter the request and
+    response bodies that cross that point.
+    """
+
+    def __init__(self, app, measurement, side):
+        self.app = app
+        self.measurement = measurement
+        self.side = side
+
+    def __call__(self, env, start_response):
+        if self.measurement.method == 'put' and 'wsgi.input' in env:
+            env['wsgi.input'] = _MeteredInput(env['wsgi.input'],
+                                              self.measurement, self.side)
+        app_iter = self.app(env, start_response)
+        if self.measurement.method == 'get':
+            return _MeteredIter(app_iter, self.measurement, self.side)
+        if self.side == 'outer':
+            self.measurement.record()
+        return app_iter
+
@@ -0,0 +1,197 @@
+'''
+Cross-worker shared-memory cache of the filter policies.
+
+The whole policy store (every 'pipeline:*' hash of the controller's Redis)
+is kept in a memory-mapped file shared by all the workers of a node. One
+worker per node, the one holding an exclusive flock on the file, refreshes
+it periodically; the other workers only read it, without locks, so the
+node-level Redis load does not depend on the number of workers.
+
+Layout (little-endian):
+
+    header: magic (4s) | generation (Q) | refreshed_at (d) | count (I)
+    index:  count * (key_offset, key_length, value_offset, value_length) (I)
+    blob:   keys and values; a value is the compact JSON of the hash
+
+Index entries are sorted by key, so a lookup is a binary search on the
+mmap and only the looked-up hashes are deserialized. The generation is odd
+while the writer is updating the table; readers retry when it is odd or
+when it changed during their read (seqlock).
+'''
+from eventlet import sleep
+from eventlet import spawn
+import fcntl
+import json
+import mmap
+import os
+import struct
+import time
+
+MAGIC = b'CRPC'
+HEADER = struct.Struct('<4sQdI')
+ENTRY = struct.Struct('<IIII')
+GENERATION = struct.Struct('<Q')
+GENERATION_OFFSET = 4
+READ_RETRIES = 3
+
+
+def _to_bytes(value):
+    if isinstance(value, bytes):
+        return value
+    return value.encode('utf-8')
+
+
+def serialize_policies(policies):
+    """
+    :param policies: dict {redis key: {field: value}}
+    :return: (count, index and blob bytes) of the table
+    """
+    keys = sorted(_to_bytes(key) for key in policies)
+    values = dict((_to_bytes(key), value) for key, value in policies.items())
+    offset = HEADER.size + ENTRY.size * len(keys)
+    index = []
+    blob = []
+    for key in keys:
+        value = _to_bytes(json.dumps(values[key], separators=(',', ':')))
+        index.append(ENTRY.pack(offset, len(key),
+                                offset + len(key), len(value)))
+        blob.append(key)
+        blob.append(value)
+        offset += len(key) + len(value)
+    return len(keys), b''.join(index) + b''.join(blob)
+
+
+class SharedPolicyCache(object):
+
+    def __init__(self, conf, redis_client, logger=None):
+        self.path = conf.get('policy_cache_path',
+                             '/dev/shm/crystal_policy_cache')
+        self.size = int(conf.get('policy_cache_size', 16 * 1024 * 1024))
+        self.refresh_interval = float(conf.get('policy_cache_refresh', 5))
+        self.max_age = float(conf.get('policy_cache_max_age', 60))
+        self.redis = redis_client
+        self.logger = logger
+        self.pid = None
+        self.fd = None
+        self.map = None
+
+    def _open(self):
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        if os.fstat(self.fd).st_size < self.size:
+            os.ftruncate(self.fd, self.size)
+        self.map = mmap.mmap(self.fd, self.size)
+
+    def ensure_started(self):
+        """
+        Maps the table and starts the refresher loop in the current worker
+        (workers are forked after the middleware is loaded)
+        """
+        if self.pid == os.getpid():
+            return
+        self.pid = os.getpid()
+        self._open()
+        spawn(self._refresher)
+
+    def _refresher(self):
+        while True:
+            try:
+                fcntl.flock(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except IOError:
+                # Another worker of the node is the refresher
+                sleep(self.refresh_interval)
+
+        while True:
+            try:
+                self.refresh()
+            except Exception:
+                if self.logger:
+                    self.logger.exception('Unable to refresh the shared '
+                                          'policy cache')
+            sleep(self.refresh_interval)
+
+    def _load_policies(self):
+        keys = list(self.redis.scan_iter(match='pipeline:*'))
+        pipe = self.redis.pipeline(transaction=False)
+        for key in keys:
+            pipe.hgetall(key)
+        # Keys deleted since the scan come back empty: they do not exist
+        return dict((key, value) for key, value in zip(keys, pipe.execute())
+                    if value)
+
+    def refresh(self):
+        count, data = serialize_policies(self._load_policies())
+        if HEADER.size + len(data) > self.size:
+            if self.logger:
+                self.logger.error('Policies do not fit in the shared policy '
+                                  'cache (%d bytes)', HEADER.size + len(data))
+            return
+
+        generation = GENERATION.unpack_from(self.map, GENERATION_OFFSET)[0]
+        if generation % 2:
+            # A previous writer died while writing
+            generation += 1
+        GENERATION.pack_into(self.map, GENERATION_OFFSET, generation + 1)
+        self.map[HEADER.size:HEADER.size + len(data)] = data
+        HEADER.pack_into(self.map, 0, MAGIC, generation + 2,
+                         time.time(), count)
+
+    def _find(self, count, key):
+        low, high = 0, count - 1
+        while low <= high:
+            middle = (low + high) // 2
+            key_offset, key_length, value_offset, value_length = \
+                ENTRY.unpack_from(self.map, HEADER.size + middle * ENTRY.size)
+            current = self.map[key_offset:key_offset + key_length]
+            if current == key:
+                return json.loads(
+                    self.map[value_offset:value_offset + value_length])
+            if current < key:
+                low = middle + 1
+            else:
+                high = middle - 1
+        return None
+
+    def _lookup(self, account, container):
+        magic, generation, refreshed_at, count = \
+            HEADER.unpack_from(self.map, 0)
+        if magic != MAGIC or generation % 2 or \
+           time.time() - refreshed_at > self.max_age:
+            return None, generation
+
+        # Same resolution as the Lua script registered in filter_factory
+        prefix = b'pipeline:' + _to_bytes(account)
+        pipeline = self._find(count, prefix + b':' + _to_bytes(container))
+        if not pipeline:
+            # Like EXISTS in the Lua script: an empty hash does not exist
+            pipeline = self._find(count, prefix)
+        global_filters = self._find(count, b'pipeline:global')
+
+        redis_list = []
+        for field, value in (pipeline or {}).items():
+            redis_list.extend((field, value))
+        redis_list.append('@@@@')
+        for field, value in (global_filters or {}).items():
+            redis_list.extend((field, value))
+        return redis_list, generation
+
+    def get_pipeline(self, account, container):
+        """
+        :return: the pipeline in the format returned by the Lua script, or
+                 None if the table is not usable (callers go to Redis)
+        """
+        self.ensure_started()
+        for _ in range(READ_RETRIES):
+            try:
+                redis_list, generation = self._lookup(account, container)
+            except (ValueError, struct.error):
+                # Torn read while the table was being written
+                continue
+            if redis_list is None:
+                if generation % 2:
+                    continue
+                return None
+            if GENERATION.unpack_from(self.map, GENERATION_OFFSET)[0] == \
+               generation:
+                return redis_list
+        return None
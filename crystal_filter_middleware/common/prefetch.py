@@ -0,0 +1,133 @@
+'''
+Read-ahead prefetch of GET response bodies.
+
+A greenthread reads up to N chunks ahead of the consumer into a bounded
+queue, so that disk/network I/O of the producer (backend, storlet gateway)
+overlaps with the filter computation and the client writes.
+'''
+from eventlet import GreenletExit
+from eventlet import spawn
+from eventlet.queue import Queue
+import time
+
+_END = object()
+
+
+class _Failure(object):
+
+    def __init__(self, error):
+        self.error = error
+
+
+class PrefetchStats(object):
+    """
+    Queue depth and consumer stall time, logged periodically
+    """
+
+    def __init__(self, report_interval, logger=None):
+        self.report_interval = report_interval
+        self.logger = logger
+        self._reset()
+        self.last_report = time.time()
+
+    def _reset(self):
+        self.gets = 0
+        self.depth = 0
+        self.stalls = 0
+        self.stall_time = 0.0
+
+    def add(self, depth, stall_time):
+        self.gets += 1
+        self.depth += depth
+        if stall_time:
+            self.stalls += 1
+            self.stall_time += stall_time
+
+    def maybe_report(self):
+        if self.logger is None or not self.gets or \
+           time.time() - self.last_report < self.report_interval:
+            return
+        self.last_report = time.time()
+        self.logger.info('crystal prefetch chunks=%d avg_depth=%.2f '
+                         'stalls=%d stall_time=%.4f',
+                         self.gets, float(self.depth) / self.gets,
+                         self.stalls, self.stall_time)
+        self._reset()
+
+
+class PrefetchIter(object):
+    """
+    Iterator that prefetches up to depth chunks of app_iter from a
+    greenthread. Closing it (e.g. on client disconnect) stops the
+    greenthread, drops the buffered chunks and closes app_iter.
+    """
+
+    def __init__(self, app_iter, depth, stats=None):
+        self.app_iter = app_iter
+        self.queue = Queue(depth)
+        self.stats = stats
+        self.finished = False
+        self.reader = spawn(self._read)
+
+    def _read(self):
+        try:
+            for chunk in self.app_iter:
+                self.queue.put(chunk)
+            self.queue.put(_END)
+        except GreenletExit:
+            pass
+        except Exception as e:
+            self.queue.put(_Failure(e))
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self.finished:
+            raise StopIteration()
+        depth = self.queue.qsize()
+        stall_time = 0
+        if depth:
+            item = self.queue.get()
+        else:
+            start = time.time()
+            item = self.queue.get()
+            stall_time = time.time() - start
+        if self.stats:
+            self.stats.add(depth, stall_time)
+
+        if item is _END:
+            self.finished = True
+            raise StopIteration()
+        if isinstance(item, _Failure):
+            self.finished = True
+            raise item.error
+        return item
+    __next__ = next
+
+    def close(self):
+        self.finished = True
+        self.reader.kill()
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        if hasattr(self.app_iter, 'close'):
+            self.app_iter.close()
+        if self.stats:
+            self.stats.maybe_report()
+
+
+class PrefetchPoint(object):
+    """
+    WSGI middleware that prefetches the GET response body of its app
+    """
+
+    def __init__(self, app, depth, stats=None):
+        self.app = app
+        self.depth = depth
+        self.stats = stats
+
+    def __call__(self, env, start_response):
+        app_iter = self.app(env, start_response)
+        if env.get('REQUEST_METHOD') != 'GET':
+            return app_iter
+        return PrefetchIter(app_iter, self.depth, self.stats)
@@ -0,0 +1,196 @@
+'''
+On-demand profiling of single requests.
+
+A request is profiled end to end (policy lookup, condition evaluation,
+pipeline build and streaming of the body through the filters) when it
+carries the X-Crystal-Profile header with the operator's profile_token, or
+when it is sampled with profile_sample_rate. Each profile is written to
+profile_dir as a pstats file and a collapsed-stack file that can be fed to
+flamegraph.pl.
+
+All the greenthreads of a worker share the same OS thread, and so the same
+profiler hook: at most one request is profiled at a time per worker. The
+hook is only enabled while the greenthread of the profiled request runs
+(work that request hands to other greenthreads, such as prefetching, is
+not recorded), and for at most profile_max_duration seconds, which bounds
+the overhead for the rest of the worker.
+'''
+import cProfile
+import greenlet
+import hmac
+import os
+import pstats
+import random
+import time
+
+PROFILE_HEADER = 'X-Crystal-Profile'
+MAX_STACK_DEPTH = 64
+MAX_WALKED_FRAMES = 100000
+
+
+def _label(func):
+    filename, line, name = func
+    return '%s:%d:%s' % (os.path.basename(filename), line, name)
+
+
+def collapsed_stacks(stats):
+    """
+    Converts the caller/callee graph of a pstats.Stats into collapsed
+    stacks ("root;caller;callee microseconds"). The self time of a function
+    is split among its callers in proportion to their number of calls.
+    """
+    lines = dict()
+    entries = stats.stats
+    callees = dict()
+    for callee, entry in entries.items():
+        for caller, caller_stats in entry[4].items():
+            callees.setdefault(caller, []).append((callee, caller_stats[0]))
+    budget = [MAX_WALKED_FRAMES]
+
+    def walk(func, stack, share):
+        budget[0] -= 1
+        stack = stack + (func,)
+        micros = int(entries[func][2] * share * 1000000)
+        if micros:
+            key = ';'.join(_label(f) for f in stack)
+            lines[key] = lines.get(key, 0) + micros
+        if len(stack) >= MAX_STACK_DEPTH:
+            return
+        for callee, calls in callees.get(func, ()):
+            if callee not in stack and budget[0] > 0:
+                total_calls = entries[callee][1] or 1
+                walk(callee, stack, share * calls / float(total_calls))
+
+    for func, entry in entries.items():
+        if not entry[4]:
+            walk(func, (), 1.0)
+
+    return ['%s %d' % (stack, micros) for stack, micros in lines.items()]
+
+
+class RequestProfiler(object):
+
+    def __init__(self, conf, logger):
+        self.logger = logger
+        self.token = conf.get('profile_token')
+        self.sample_rate = float(conf.get('profile_sample_rate', 0))
+        self.directory = conf.get('profile_dir',
+                                  '/var/cache/crystal/profiles')
+        self.max_files = int(conf.get('profile_max_files', 50))
+        self.max_duration = float(conf.get('profile_max_duration', 10))
+        self.active = False
+        self.profile = None
+        self.greenlet = None
+        self.started = 0
+        self.previous_trace = None
+
+    def should_profile(self, req):
+        """
+        :return: True if the request is authorised or sampled for profiling
+                 and no other request is being profiled in this worker
+        """
+        header = req.headers.pop(PROFILE_HEADER, None)
+        if self.active:
+            return False
+        if header is not None and self.token and \
+           hmac.compare_digest(str(header), str(self.token)):
+            return True
+        return self.sample_rate > 0 and random.random() < self.sample_rate
+
+    def start(self):
+        self.active = True
+        self.profile = profile = cProfile.Profile()
+        self.greenlet = greenlet.getcurrent()
+        self.started = time.time()
+        self.previous_trace = greenlet.settrace(self._trace)
+        profile.enable()
+        return profile
+
+    def expired(self):
+        return time.time() - self.started > self.max_duration
+
+    def _trace(self, event, args):
+        """
+        Greenlet switch hook: profiles only the greenthread of the request
+        """
+        if event in ('switch', 'throw'):
+            origin, target = args
+            if origin is self.greenlet:
+                self.profile.disable()
+            elif target is self.greenlet and not self.expired():
+                self.profile.enable()
+        if self.previous_trace is not None:
+            self.previous_trace(event, args)
+
+    def finish(self, profile, req):
+        profile.disable()
+        greenlet.settrace(self.previous_trace)
+        self.active = False
+        self.profile = None
+        self.greenlet = None
+        self.previous_trace = None
+        try:
+            self._write(profile, req)
+        except Exception:
+            self.logger.exception('Unable to write the request profile')
+
+    def _write(self, profile, req):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        name = '%.6f-%s' % (time.time(),
+                            req.environ.get('swift.trans_id', 'request'))
+        path = os.path.join(self.directory, name)
+        profile.dump_stats(path + '.pstats')
+        stats = pstats.Stats(path + '.pstats')
+        with open(path + '.collapsed', 'w') as f:
+            f.write('\n'.join(collapsed_stacks(stats)) + '\n')
+        self.logger.info('crystal request profile %s %s written to %s',
+                         req.method, req.path, path)
+        self._rotate()
+
+    def _rotate(self):
+        """
+        Keeps only the newest profile_max_files profiles
+        """
+        names = sorted(set(os.path.splitext(f)[0]
+                           for f in os.listdir(self.directory)
+                           if f.endswith(('.pstats', '.collapsed'))))
+        for name in names[:-self.max_files]:
+            for extension in ('.pstats', '.collapsed'):
+                path = os.path.join(self.directory, name + extension)
+                if os.path.exists(path):
+                    os.unlink(path)
+
+
+class ProfiledIter(object):
+    """
+    Keeps profiling while the response body streams through the filters
+    """
+
+    def __init__(self, app_iter, profiler, profile, req):
+        self.app_iter = app_iter
+        self.iterator = iter(app_iter)
+        self.profiler = profiler
+        self.profile = profile
+        self.req = req
+        self.finished = False
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if not self.finished and self.profiler.expired():
+            # Stop profiling long bodies; the rest streams unprofiled
+            self.finished = True
+            self.profiler.finish(self.profile, self.req)
+        return next(self.iterator)
+    __next__ = next
+
+    def close(self):
+        try:
+            if hasattr(self.app_iter, 'close'):
+                self.app_iter.close()
+        finally:
+            if not self.finished:
+                self.finished = True
+                self.profiler.finish(self.profile, self.req)
@@ -0,0 +1,132 @@
+'''
+Chunk coalescing and re-chunking between pipeline stages.
+
+Some filters (and storlet gateways) emit tiny chunks, which multiplies the
+per-chunk overhead of every later stage and of the WSGI server. The
+RechunkPoint placed after every stage coalesces small chunks up to a target
+size, using a preallocated buffer, and splits the huge ones.
+'''
+import time
+
+
+class ChunkSizeHistogram(object):
+    """
+    Power-of-two histogram of the chunk sizes produced by each stage
+    """
+
+    def __init__(self, report_interval, logger=None):
+        self.report_interval = report_interval
+        self.logger = logger
+        self.stages = dict()
+        self.last_report = time.time()
+
+    def add(self, stage, size):
+        buckets = self.stages.get(stage)
+        if buckets is None:
+            buckets = self.stages[stage] = [0] * 33
+        buckets[min(size.bit_length(), 32)] += 1
+
+    def maybe_report(self):
+        if self.logger is None or \
+           time.time() - self.last_report < self.report_interval:
+            return
+        self.last_report = time.time()
+        stages, self.stages = self.stages, dict()
+        for stage, buckets in stages.items():
+            histogram = ' '.join('<%d:%d' % (1 << bucket, count)
+                                 for bucket, count in enumerate(buckets)
+                                 if count)
+            self.logger.info('crystal chunk sizes stage=%s %s',
+                             stage, histogram)
+
+
+class RechunkIter(object):
+    """
+    Iterator that coalesces chunks smaller than chunk_size and splits those
+    larger than max_chunk_size into chunk_size pieces. Chunks in between
+    are passed through without copying when nothing is buffered.
+    """
+
+    def __init__(self, app_iter, chunk_size, max_chunk_size,
+                 histogram=None, stage=None):
+        self.app_iter = app_iter
+        self.chunk_size = chunk_size
+        self.max_chunk_size = max_chunk_size
+        self.histogram = histogram
+        self.stage = stage
+        self.iterator = self._rechunk()
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        return next(self.iterator)
+    __next__ = next
+
+    def close(self):
+        if hasattr(self.app_iter, 'close'):
+            self.app_iter.close()
+        if self.histogram:
+            self.histogram.maybe_report()
+
+    def _rechunk(self):
+        size = self.chunk_size
+        max_size = self.max_chunk_size
+        histogram = self.histogram
+        buf = memoryview(bytearray(size))
+        fill = 0
+
+        for chunk in self.app_iter:
+            length = len(chunk)
+            if histogram:
+                histogram.add(self.stage, length)
+            if not length:
+                continue
+
+            pos = 0
+            if fill:
+                take = min(size - fill, length)
+                buf[fill:fill + take] = chunk[:take]
+                fill += take
+                pos = take
+                if fill < size:
+                    continue
+                yield buf.tobytes()
+                fill = 0
+
+            rest = length - pos
+            if rest >= size:
+                if rest <= max_size:
+                    yield chunk[pos:] if pos else chunk
+                    continue
+                while rest >= size:
+                    yield chunk[pos:pos + size]
+                    pos += size
+                    rest -= size
+            if rest:
+                buf[0:rest] = chunk[pos:]
+                fill = rest
+
+        if fill:
+            yield buf[:fill].tobytes()
+
+
+class RechunkPoint(object):
+    """
+    WSGI middleware that re-chunks the response body produced by a stage
+    """
+
+    def __init__(self, app, chunk_size, max_chunk_size, histogram=None,
+                 stage=None):
+        self.app = app
+        self.chunk_size = chunk_size
+        self.max_chunk_size = max_chunk_size
+        self.histogram = histogram
+        self.stage = stage
+
+    def __call__(self, env, start_response):
+        app_iter = self.app(env, start_response)
+        if env.get('REQUEST_METHOD') != 'GET':
+            return app_iter
+        return RechunkIter(app_iter, self.chunk_size, self.max_chunk_size,
+                           self.histogram, self.stage)
@@ -0,0 +1,178 @@
+'''
+Request scoped logging for the Crystal filter middleware.
+
+Instead of several free-text lines per request, each handler accumulates
+what happened (filters run, stage durations) in a RequestLog, and a single
+structured line is emitted when the middleware finishes the request, once
+the response body has been streamed through the filters.
+'''
+from contextlib import contextmanager
+import logging
+import random
+import time
+import zlib
+
+
+def _enabled_for(logger, level):
+    """
+    Swift's LogAdapter and plain loggers both offer isEnabledFor; anything
+    else is considered enabled so that messages are never lost.
+    """
+    is_enabled_for = getattr(logger, 'isEnabledFor', None)
+    if is_enabled_for is None:
+        return True
+    return is_enabled_for(level)
+
+
+def log_debug(logger, msg, *args):
+    """
+    Debug logging with lazy formatting, guarded by a level check
+    """
+    if _enabled_for(logger, logging.DEBUG):
+        logger.debug(msg, *args)
+
+
+def parse_sample_rates(value):
+    """
+    Provides "AUTH_a:0.5, AUTH_b:1" as a dictionary {'AUTH_a': 0.5, ...}
+    """
+    rates = dict()
+    for item in value.split(','):
+        item = item.strip()
+        if not item:
+            continue
+        account, rate = item.rsplit(':', 1)
+        rates[account.strip()] = float(rate)
+    return rates
+
+
+class PipelineLogSampler(object):
+    """
+    Decides, per tenant, whether the full filter pipeline of a request is
+    dumped to the log.
+    """
+
+    def __init__(self, conf):
+        self.default_rate = float(conf.get('log_pipeline_sample_rate', 0.0))
+        self.account_rates = parse_sample_rates(
+            conf.get('log_pipeline_sample_accounts', ''))
+
+    def should_dump(self, account):
+        rate = self.account_rates.get(account, self.default_rate)
+        if rate <= 0:
+            return False
+        return rate >= 1 or random.random() < rate
+
+
+class RequestLog(object):
+    """
+    Accumulates the events of a single request and emits them as one
+    structured line.
+    """
+
+    def __init__(self, logger, sampler, server, request):
+        self.logger = logger
+        self.sampler = sampler
+        self.server = server
+        self.request = request
+        self.filters = []
+        self.durations = []
+        self.start = time.time()
+
+    @contextmanager
+    def timed(self, stage):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.durations.append((stage, time.time() - start))
+
+    def pipeline(self, account, filter_exec_list):
+        """
+        Records the filters that are going to be executed. The whole
+        execution list is only dumped for sampled tenants or at debug level.
+        """
+        for key in sorted(filter_exec_list):
+            self.filters.append(filter_exec_list[key]['name'])
+
+        if self.sampler and self.sampler.should_dump(account):
+            self.logger.info('crystal pipeline dump trans_id=%s %s',
+                             self.trans_id, filter_exec_list)
+        else:
+            log_debug(self.logger, 'crystal pipeline dump trans_id=%s %s',
+                      self.trans_id, filter_exec_list)
+
+    @property
+    def trans_id(self):
+        return self.request.environ.get('swift.trans_id', '-')
+
+    @property
+    def pipeline_id(self):
+        """
+        Short identifier of the pipeline shape, equal for all the requests
+        that run the same filters in the same order.
+        """
+        if not self.filters:
+            return '-'
+        return '%08x' % (zlib.crc32('|'.join(self.filters).encode('utf-8'))
+                         & 0xffffffff)
+
+    def emit(self, status, body='-'):
+        """
+        :param body: 'complete' or 'incomplete' if the response body was
+                     streamed, '-' otherwise
+        """
+        if not _enabled_for(self.logger, logging.INFO):
+            return
+        durations = ','.join('%s:%.4f' % (stage, elapsed)
+                             for stage, elapsed in self.durations)
+        self.logger.info(
+            'crystal server=%s trans_id=%s method=%s path=%s status=%s '
+            'pipeline=%s filters=%s body=%s durations=%s total=%.4f',
+            self.server, self.trans_id, self.request.method,
+            self.request.path, status, self.pipeline_id,
+            ','.join(self.filters) or '-', body, durations or '-',
+            time.time() - self.start)
+
+
+class LoggedIter(object):
+    """
+    Emits the summary of the request when its response body is closed,
+    with the time spent producing the body (backend and filters) as the
+    'stream' stage
+    """
+
+    def __init__(self, app_iter, request_log, status):
+        self.app_iter = app_iter
+        self.iterator = iter(app_iter)
+        self.request_log = request_log
+        self.status = status
+        self.stream_time = 0.0
+        self.completed = False
+        self.emitted = False
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        start = time.time()
+        try:
+            return next(self.iterator)
+        except StopIteration:
+            self.completed = True
+            raise
+        finally:
+            self.stream_time += time.time() - start
+    __next__ = next
+
+    def close(self):
+        try:
+            if hasattr(self.app_iter, 'close'):
+                self.app_iter.close()
+        finally:
+            if not self.emitted:
+                self.emitted = True
+                self.request_log.durations.append(('stream',
+                                                   self.stream_time))
+                self.request_log.emit(self.status, 'complete'
+                                      if self.completed else 'incomplete')
@@ -0,0 +1,68 @@
+'''
+Coalescing of concurrent identical lookups (singleflight).
+
+When several greenthreads of a worker run the same lookup at the same time
+(policy evalsha, account info, HEAD of a hot object), only the first one
+runs it; the others wait for it and share its result, or its exception.
+'''
+from eventlet.event import Event
+import time
+
+_RETRY = object()
+
+
+class SingleFlight(object):
+
+    def __init__(self, report_interval=300, logger=None):
+        self.report_interval = report_interval
+        self.logger = logger
+        self.in_flight = dict()
+        self.calls = dict()
+        self.merged = dict()
+        self.last_report = time.time()
+
+    def do(self, kind, key, func, *args):
+        """
+        Runs func(*args) unless an identical call is already in flight
+
+        :param kind: type of lookup; keys of different kinds never merge
+        :param key: hashable identifier of the call within its kind
+        """
+        flight_key = (kind, key)
+        self.calls[kind] = self.calls.get(kind, 0) + 1
+        event = self.in_flight.get(flight_key)
+        if event is not None:
+            self.merged[kind] = self.merged.get(kind, 0) + 1
+            result = event.wait()
+            if result is _RETRY:
+                # The leader was killed before finishing: run it again
+                return self.do(kind, key, func, *args)
+            return result
+
+        event = self.in_flight[flight_key] = Event()
+        try:
+            result = func(*args)
+        except Exception as e:
+            event.send_exception(e)
+            raise
+        except BaseException:
+            # GreenletExit or eventlet Timeout of the leader only
+            event.send(_RETRY)
+            raise
+        finally:
+            del self.in_flight[flight_key]
+        event.send(result)
+        self.maybe_report()
+        return result
+
+    def maybe_report(self):
+        if self.logger is None or \
+           time.time() - self.last_report < self.report_interval:
+            return
+        self.last_report = time.time()
+        for kind in sorted(self.calls):
+            self.logger.info('crystal singleflight kind=%s calls=%d '
+                             'merged=%d', kind, self.calls[kind],
+                             self.merged.get(kind, 0))
+        self.calls = dict()
+        self.merged = dict()
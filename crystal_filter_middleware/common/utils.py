@@ -0,0 +1,14 @@
+import redis
+
+
+def get_redis(conf):
+    """
+    Returns a Redis client that uses the connection pool shared by the
+    worker (created in filter_factory), if any.
+    """
+    pool = conf.get('redis_pool')
+    if pool is not None:
+        return redis.StrictRedis(connection_pool=pool)
+    return redis.StrictRedis(conf.get('redis_host'),
+                             conf.get('redis_port'),
+                             conf.get('redis_db'))
@@ -0,0 +1,111 @@
+'''
+Warm startup of the Crystal filter middleware.
+
+Run from filter_factory, before the worker serves any request, so that the
+first requests after a (rolling) restart do not pay for importing native
+filters or connecting to the controller.
+'''
+from contextlib import contextmanager
+from eventlet import Timeout
+import json
+import time
+
+
+class WarmupReport(object):
+    """
+    Time spent in each warmup step
+    """
+
+    def __init__(self):
+        self.steps = []
+
+    @contextmanager
+    def timed(self, name):
+        """
+        Times a mandatory step: errors are raised to the caller
+        """
+        start = time.time()
+        try:
+            yield
+        except Exception:
+            self.steps.append((name, time.time() - start, 'error'))
+            raise
+        self.steps.append((name, time.time() - start, 'ok'))
+
+    def run(self, name, func, *args):
+        """
+        Runs an optional step: errors are only reported
+        """
+        start = time.time()
+        try:
+            result = func(*args)
+            self.steps.append((name, time.time() - start, 'ok'))
+            return result
+        except Timeout:
+            self.steps.append((name, time.time() - start, 'timeout'))
+            raise
+        except Exception as e:
+            self.steps.append((name, time.time() - start, 'error: %s' % e))
+
+    def __str__(self):
+        return ', '.join('%s=%.3fs (%s)' % step for step in self.steps)
+
+
+def _prime_redis(r, pool_size):
+    """
+    Opens pool_size connections of the shared pool
+    """
+    pool = r.connection_pool
+    connections = [pool.get_connection('PING') for _ in range(pool_size)]
+    for connection in connections:
+        connection.send_command('PING')
+        connection.read_response()
+        pool.release(connection)
+
+
+def _get_native_filters(r):
+    """
+    Returns the native filters referenced by the current Redis policies
+    """
+    native_filters = dict()
+    for key in r.scan_iter(match='pipeline:*'):
+        for filter_metadata in r.hvals(key):
+            filter_metadata = json.loads(filter_metadata)
+            if filter_metadata.get('filter_type') == 'native':
+                modulename = filter_metadata['filter_name'].split('.')[0]
+                native_filters[modulename] = filter_metadata['main']
+    return native_filters
+
+
+def _import_native_filters(native_filters, logger):
+    for modulename, classname in native_filters.items():
+        try:
+            m = __import__(modulename, globals(), locals(), [classname])
+            getattr(m, classname)
+        except Exception as e:
+            logger.error('Unable to preload native filter %s.%s: %s',
+                         modulename, classname, e)
+
+
+def warmup(conf, r, logger, report):
+    """
+    Runs the optional warmup steps with an overall timeout.
+
+    :param r: Redis client of the shared connection pool
+    :param report: WarmupReport with the mandatory steps already timed
+    """
+    timeout = float(conf.get('warmup_timeout', 10))
+    pool_size = int(conf.get('warmup_redis_connections', 1))
+
+    try:
+        with Timeout(timeout):
+            report.run('redis_pool', _prime_redis, r, pool_size)
+            native_filters = report.run('policies', _get_native_filters, r)
+            if native_filters:
+                report.run('native_filters', _import_native_filters,
+                           native_filters, logger)
+    except Timeout:
+        logger.warning('Crystal warmup timed out after %ss', timeout)
+
+    logger.info('Crystal warmup: %s', report)
+    return report
@@ -1,10 +1,32 @@
 from swift.common.swob import HTTPInternalServerError
 from swift.common.swob import HTTPException
 from swift.common.swob import wsgify
+from swift.common.swob import status_map
 from swift.common.utils import get_logger
+from swift.common.utils import config_true_value
 from crystal_filter_middleware.handlers import CrystalProxyHandler
 from crystal_filter_middleware.handlers import CrystalObjectHandler
 from crystal_filter_middleware.handlers.base import NotCrystalRequest
+from crystal_filter_middleware.common.request_log import PipelineLogSampler
+from crystal_filter_middleware.common.request_log import log_debug
+from crystal_filter_middleware.common.request_log import LoggedIter
+from crystal_filter_middleware.common.placement import FilterStatsRecorder
+from crystal_filter_middleware.common.placement import PlacementEngine
+from crystal_filter_middleware.common.rechunk import ChunkSizeHistogram
+from crystal_filter_middleware.common.prefetch import PrefetchStats
+from crystal_filter_middleware.common.admission import AdmissionController
+from crystal_filter_middleware.common.admission import AdmissionRejected
+from crystal_filter_middleware.common.admission import AdmittedIter
+from crystal_filter_middleware.common.breaker import CircuitBreaker
+from crystal_filter_middleware.common.breaker import LastKnownGood
+from crystal_filter_middleware.common.policy_cache import SharedPolicyCache
+from crystal_filter_middleware.common.batch import BatchPolicyCache
+from crystal_filter_middleware.common.singleflight import SingleFlight
+from crystal_filter_middleware.common.profiler import RequestProfiler
+from crystal_filter_middleware.common.profiler import ProfiledIter
+from crystal_filter_middleware.common.utils import get_redis
+from crystal_filter_middleware.common.warmup import WarmupReport
+from crystal_filter_middleware.common.warmup import warmup
 import ConfigParser
 import redis
 import sys
@@ -26,6 +48,29 @@ class CrystalHandlerMiddleware(object):
                                  "-server Crystal Filters",
                                  log_route='crystal_filter_handler')
         self.handler_class = self._get_handler(self.exec_server)
+        parse_options(self.conf)
+        self.log_request_summary = self.conf['log_request_summary']
+        if self.conf['rechunk_enabled']:
+            self.conf['rechunk_histogram'] = ChunkSizeHistogram(
+                self.conf['rechunk_report_interval'], self.logger)
+        self.conf['prefetch_stats'] = PrefetchStats(
+            self.conf['prefetch_report_interval'], self.logger)
+        if self.conf['singleflight_enabled']:
+            self.conf['singleflight'] = SingleFlight(
+                self.conf['singleflight_report_interval'], self.logger)
+        for component in ('redis_breaker', 'policy_cache',
+                          'placement_recorder'):
+            if self.conf.get(component):
+                self.conf[component].logger = self.logger
+        self.admission = None
+        if self.conf['admission_enabled']:
+            self.admission = AdmissionController(self.conf, self.logger)
+            self.conf['admission_controller'] = self.admission
+        self.admission_reject_status = self.conf['admission_reject_status']
+        self.profiler = None
+        if self.conf.get('profile_token') or \
+           self.conf['profile_sample_rate'] > 0:
+            self.profiler = RequestProfiler(self.conf, self.logger)
 
     def _get_handler(self, exec_server):
         if exec_server == 'proxy':
@@ -41,68 +86,221 @@ class CrystalHandlerMiddleware(object):
         try:
             request_handler = self.handler_class(req, self.conf,
                                                  self.app, self.logger)
-            self.logger.debug('%s call in %s-server with %s/%s/%s' %
-                              (req.method, self.exec_server, request_handler.account,
-                               request_handler.container, request_handler.obj))
+            log_debug(self.logger, '%s call in %s-server with %s/%s/%s',
+                      req.method, self.exec_server, request_handler.account,
+                      request_handler.container, request_handler.obj)
         except HTTPException:
             raise
         except NotCrystalRequest:
             return req.get_response(self.app)
 
+        status = 500
+        tickets = request_handler.admission_tickets
+        summary_pending = self.log_request_summary
+        profile = None
+        if self.profiler and self.profiler.should_profile(req):
+            profile = self.profiler.start()
         try:
-            return request_handler.handle_request()
-        except HTTPException:
+            response = request_handler.handle_request()
+            status = response.status_int
+            if tickets:
+                self._release_after_body(response, request_handler)
+                tickets = []
+            if profile and response.app_iter is not None:
+                # Keep profiling while the body streams through the filters
+                response.app_iter = ProfiledIter(response.app_iter,
+                                                 self.profiler, profile, req)
+                profile = None
+            if summary_pending and response.app_iter is not None:
+                # Logged once the body has streamed through the filters
+                response.app_iter = LoggedIter(response.app_iter,
+                                               request_handler.request_log,
+                                               status)
+                summary_pending = False
+            return response
+        except AdmissionRejected as e:
+            status = self.admission_reject_status
+            self.logger.warning('Admission rejected for %s', e)
+            return status_map[status](request=req)
+        except HTTPException as e:
+            status = e.status_int
             self.logger.exception('Middleware execution failed')
             raise
         except Exception:
             self.logger.exception('Middleware execution failed')
             raise HTTPInternalServerError(
                 body='Crystal filter middleware execution failed')
+        finally:
+            for ticket in tickets:
+                self.admission.release(ticket)
+            if profile:
+                self.profiler.finish(profile, req)
+            if summary_pending:
+                request_handler.request_log.emit(status)
 
+    def _release_after_body(self, response, request_handler):
+        """
+        Keeps the admission tickets until the response body has been sent.
+        The byte budget of the account is enforced by the proxy only.
+        """
+        tickets = request_handler.admission_tickets
+        if response.app_iter is None:
+            for ticket in tickets:
+                self.admission.release(ticket)
+        else:
+            response.app_iter = AdmittedIter(response.app_iter,
+                                             self.admission,
+                                             request_handler.account,
+                                             tickets,
+                                             self.exec_server == 'proxy')
 
-def filter_factory(global_conf, **local_conf):
+
+# Boolean options of the middleware and their defaults
+BOOLEAN_OPTIONS = (('log_request_summary', True),
+                   ('placement_enabled', False),
+                   ('rechunk_enabled', False),
+                   ('admission_enabled', False),
+                   ('warmup_enabled', True),
+                   ('redis_breaker_enabled', True),
+                   ('prefetch_enabled', False),
+                   ('policy_cache_enabled', False),
+                   ('singleflight_enabled', True),
+                   ('batch_cache_enabled', True))
+
+
+def parse_options(conf):
     """
-    Standard filter factory to use the middleware with paste.deploy
+    Parses in place the options of the middleware read outside of its
+    components, with their defaults. Parsed values are kept, so it can be
+    called both by filter_factory and by the middleware.
     """
-    conf = global_conf.copy()
-    conf.update(local_conf)
-
     conf['redis_host'] = conf.get('redis_host', 'controller')
     conf['redis_port'] = int(conf.get('redis_port', 6379))
     conf['redis_db'] = int(conf.get('redis_db', 0))
+    conf['redis_timeout'] = float(conf.get('redis_timeout', 1.0))
 
     conf['native_filters_path'] = conf.get('native_filters_path',
                                            '/opt/crystal/native_filters')
 
+    for option, default in BOOLEAN_OPTIONS:
+        conf[option] = config_true_value(conf.get(option, default))
+
+    # Chunk coalescing and re-chunking between pipeline stages
+    conf['rechunk_size'] = int(conf.get('rechunk_size', 65536))
+    conf['rechunk_max_size'] = int(conf.get('rechunk_max_size',
+                                            4 * conf['rechunk_size']))
+    conf['rechunk_report_interval'] = float(
+        conf.get('rechunk_report_interval', 300))
+
+    # Read-ahead prefetch on GET (also enabled per filter with "prefetch")
+    conf['prefetch_depth'] = int(conf.get('prefetch_depth', 4))
+    conf['prefetch_report_interval'] = float(
+        conf.get('prefetch_report_interval', 300))
+
+    # Admission control: 503 or 429 when a tenant is over budget
+    conf['admission_reject_status'] = int(
+        conf.get('admission_reject_status', 503))
+    if conf['admission_reject_status'] not in (429, 503):
+        raise ValueError('configuration error: admission_reject_status must'
+                         ' be either 429 or 503')
+
+    # Behaviour without policies from Redis
+    conf['redis_last_known_good_max_age'] = float(
+        conf.get('redis_last_known_good_max_age', 0))
+    conf['redis_failure_policy'] = conf.get('redis_failure_policy', 'closed')
+    if conf['redis_failure_policy'] not in ('open', 'closed'):
+        raise ValueError('configuration error: redis_failure_policy must be'
+                         ' either open or closed')
+
+    conf['singleflight_report_interval'] = float(
+        conf.get('singleflight_report_interval', 300))
+    conf['profile_sample_rate'] = float(conf.get('profile_sample_rate', 0))
+
+
+def filter_factory(global_conf, **local_conf):
+    """
+    Standard filter factory to use the middleware with paste.deploy
+    """
+    conf = global_conf.copy()
+    conf.update(local_conf)
+
+    parse_options(conf)
+
+    """
+    Shared connection pool for all the Redis clients of the worker (created
+    before any component that talks to Redis)
+    """
+    conf['redis_pool'] = redis.ConnectionPool(
+        host=conf['redis_host'], port=conf['redis_port'], db=conf['redis_db'],
+        socket_timeout=conf['redis_timeout'],
+        socket_connect_timeout=conf['redis_timeout'])
+
+    # Request logging: per-tenant sampling of pipeline dumps
+    conf['log_sampler'] = PipelineLogSampler(conf)
+
+    # Adaptive placement of movable filters: both servers measure, only the
+    # proxy decides
+    if conf['placement_enabled']:
+        conf['placement_recorder'] = FilterStatsRecorder(conf)
+        if conf.get('execution_server') == 'proxy':
+            conf['placement_engine'] = PlacementEngine(conf)
+
     # Add source directory to sys path
     native_filters_path = conf.get('native_filters_path')
     sys.path.insert(0, native_filters_path)
 
+    """
+    Circuit breaker on the policy lookups, serving the last-known-good
+    pipelines while it is open
+    """
+    if conf['redis_breaker_enabled']:
+        conf['redis_breaker'] = CircuitBreaker(
+            int(conf.get('redis_breaker_failures', 5)),
+            float(conf.get('redis_breaker_latency', 0.25)),
+            float(conf.get('redis_breaker_reset_timeout', 10)))
+        conf['redis_last_known_good'] = LastKnownGood(
+            int(conf.get('redis_last_known_good_entries', 10000)))
+
+    """
+    Policy table shared by all the workers of the node
+    """
+    if conf.get('execution_server') == 'proxy' and \
+       conf['policy_cache_enabled']:
+        conf['policy_cache'] = SharedPolicyCache(conf, get_redis(conf))
+
+    """
+    Pipelines shared by the subrequests of bulk operations
+    """
+    if conf.get('execution_server') == 'proxy' and \
+       conf['batch_cache_enabled']:
+        conf['batch_cache'] = BatchPolicyCache(conf)
+
+    report = WarmupReport()
+
     """
     Storlets Configuration
     """
     if STORLETS:
-        """ Load Storlets Gateway class """
-        from storlets.gateway.loader import load_gateway
-        module_name = conf.get('storlet_gateway_module', 'stub')
-        gateway_class = load_gateway(module_name)
-        conf['storlets_gateway_module'] = gateway_class
+        with report.timed('storlet_gateway'):
+            """ Load Storlets Gateway class """
+            from storlets.gateway.loader import load_gateway
+            module_name = conf.get('storlet_gateway_module', 'stub')
+            gateway_class = load_gateway(module_name)
+            conf['storlets_gateway_module'] = gateway_class
 
-        """ Load Storlets Gateway configuration """
-        configParser = ConfigParser.RawConfigParser()
-        configParser.read(conf.get('storlet_gateway_conf',
-                                   '/etc/swift/storlet_stub_gateway.conf'))
-        additional_items = configParser.items("DEFAULT")
+            """ Load Storlets Gateway configuration """
+            configParser = ConfigParser.RawConfigParser()
+            configParser.read(conf.get('storlet_gateway_conf',
+                                       '/etc/swift/storlet_stub_gateway.conf'))
+            additional_items = configParser.items("DEFAULT")
 
-        for key, val in additional_items:
-            conf[key] = val
+            for key, val in additional_items:
+                conf[key] = val
 
     """
     Register Lua script to retrieve policies in a single redis call
     """
-    r = redis.StrictRedis(conf['redis_host'],
-                          conf['redis_port'],
-                          conf['redis_db'])
+    r = get_redis(conf)
     lua = """
         local t = {}
         if redis.call('EXISTS', 'pipeline:'..ARGV[1]..':'..ARGV[2])==1 then
@@ -116,9 +314,19 @@ def filter_factory(global_conf, **local_conf):
           t[#t+1] = t3[i]
         end
         return t"""
-    lua_sha = r.script_load(lua)
+    with report.timed('lua_script'):
+        lua_sha = r.script_load(lua)
     conf['LUA_get_pipeline_sha'] = lua_sha
 
+    """
+    Warm startup: preload native filters and prime the connection pool
+    """
+    if conf['warmup_enabled']:
+        logger = get_logger(conf, name=conf.get('execution_server') +
+                            "-server Crystal Filters",
+                            log_route='crystal_filter_handler')
+        warmup(conf, r, logger, report)
+
     def crystal_filter_handler(app):
         return CrystalHandlerMiddleware(app, conf)
 
@@ -9,6 +9,7 @@ from swift.common.swob import Request
 from swift.common.utils import config_true_value
 from storlets.swift_middleware.handlers.base import SwiftFileManager
 from swift.common.swob import wsgify
+from crystal_filter_middleware.common.prefetch import PrefetchIter
 
 
 class StorletFilter(object):
@@ -120,8 +121,8 @@ class StorletFilter(object):
 
             self.scope = self.account[5:18]
 
-            self.logger.info('Go to execute ' + storlet +
-                             ' storlet with parameters "' + str(params) + '"')
+            self.logger.debug('Go to execute %s storlet with parameters "%s"',
+                              storlet, params)
 
             self._setup_gateway()
 
@@ -131,7 +132,14 @@ class StorletFilter(object):
             if req.method == 'GET':
                 response = req.get_response(self.app)
                 data_iter = response.app_iter
-                response.app_iter = self._call_gateway(response, params, data_iter)
+                storlet_iter = self._call_gateway(response, params, data_iter)
+                if self.conf.get('prefetch_enabled') or \
+                   self.filter_data.get('prefetch'):
+                    # Read ahead of the client from the storlet gateway
+                    storlet_iter = PrefetchIter(storlet_iter,
+                                                self.conf['prefetch_depth'],
+                                                self.conf.get('prefetch_stats'))
+                response.app_iter = storlet_iter
 
                 if 'Content-Length' in response.headers:
                     response.headers.pop('Content-Length')
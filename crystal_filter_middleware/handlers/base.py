@@ -1,11 +1,30 @@
 from swift.proxy.controllers.base import get_account_info
 from swift.common.utils import config_true_value
+from crystal_filter_middleware.common.request_log import RequestLog
+from crystal_filter_middleware.common.request_log import log_debug
+from crystal_filter_middleware.common.placement import Measurement
+from crystal_filter_middleware.common.placement import MeterPoint
+from crystal_filter_middleware.common.rechunk import RechunkPoint
+from crystal_filter_middleware.common.prefetch import PrefetchPoint
 try:
     from crystal_filter_middleware.filters.storlet import StorletFilter
     STORLETS = True
 except:
     STORLETS = False
-import redis
+from crystal_filter_middleware.common.utils import get_redis
+
+# Lifecycle phases a filter can act on, and those each method goes through
+PHASES = frozenset(('request_body', 'response_body', 'headers', 'metadata'))
+METHOD_PHASES = {'GET': frozenset(('response_body', 'headers')),
+                 'PUT': frozenset(('request_body', 'headers', 'metadata')),
+                 'HEAD': frozenset(('headers',)),
+                 'POST': frozenset(('headers', 'metadata')),
+                 'DELETE': frozenset(('headers', 'metadata'))}
+# Phases of the filters that do not declare them
+DEFAULT_PHASES = {'storlet': frozenset(('request_body', 'response_body')),
+                  'native': PHASES}
+# Filters whose unknown phases have already been logged by this worker
+_INVALID_PHASES_LOGGED = set()
 
 
 class NotCrystalRequest(Exception):
@@ -59,10 +78,12 @@ class CrystalBaseHandler(object):
         self.redis_db = conf.get('redis_db')
 
         self.method = self.request.method.lower()
+        self.request_log = RequestLog(logger, conf.get('log_sampler'),
+                                      self.server, self.request)
+        self.admission = conf.get('admission_controller')
+        self.admission_tickets = []
 
-        self.redis = redis.StrictRedis(self.redis_host,
-                                       self.redis_port,
-                                       self.redis_db)
+        self.redis = get_redis(conf)
 
     def _extract_vaco(self):
         """
@@ -138,23 +159,21 @@ class CrystalBaseHandler(object):
         return self.request.params.get('multipart-manifest') == 'get'
 
     def is_slo_response(self, resp):
-        self.logger.debug(
-            'Verify if {0}/{1}/{2} is an SLO assembly object'.format(
-                self.account, self.container, self.obj))
         is_slo = 'X-Static-Large-Object' in resp.headers
-        if is_slo:
-            self.logger.debug(
-                '{0}/{1}/{2} is indeed an SLO assembly '
-                'object'.format(self.account, self.container, self.obj))
-        else:
-            self.logger.debug(
-                '{0}/{1}/{2} is NOT an SLO assembly object'.format(
-                    self.account, self.container, self.obj))
+        log_debug(self.logger, '%s/%s/%s is %san SLO assembly object',
+                  self.account, self.container, self.obj,
+                  '' if is_slo else 'NOT ')
         return is_slo
 
     def is_account_crystal_enabled(self):
-        account_meta = get_account_info(self.request.environ,
-                                        self.app)['meta']
+        singleflight = self.conf.get('singleflight')
+        if singleflight:
+            account_info = singleflight.do('account', self.account,
+                                           get_account_info,
+                                           self.request.environ, self.app)
+        else:
+            account_info = get_account_info(self.request.environ, self.app)
+        account_meta = account_info['meta']
         crystal_enabled = account_meta.get('crystal-enabled',
                                            'False')
 
@@ -174,17 +193,123 @@ class CrystalBaseHandler(object):
 
         return filter_class
 
-    def _build_pipeline(self, filter_exec_list):
+    def _get_filter_phases(self, filter_data):
+        phases = filter_data.get('phases')
+        if phases:
+            unknown = set(phases) - PHASES
+            if not unknown:
+                return frozenset(phases)
+            # A typo must not silently disable the filter
+            if (filter_data['name'], tuple(phases)) not in \
+               _INVALID_PHASES_LOGGED:
+                _INVALID_PHASES_LOGGED.add((filter_data['name'],
+                                            tuple(phases)))
+                self.logger.warning('Unknown phases %s of filter %s, using'
+                                    ' the default ones',
+                                    ', '.join(sorted(unknown)),
+                                    filter_data['name'])
+        return DEFAULT_PHASES.get(filter_data['type'], PHASES)
+
+    def _is_filter_reachable(self, filter_data):
+        """
+        False if the filter cannot affect a request of this method
+        """
+        method_phases = METHOD_PHASES.get(self.request.method)
+        if method_phases is None:
+            return True
+        return bool(self._get_filter_phases(filter_data) & method_phases)
+
+    def _prune_filter_execution_list(self, filter_exec_list):
+        """
+        Removes the filters that cannot affect a request of this method
+        """
+        return dict((key, filter_data)
+                    for key, filter_data in filter_exec_list.items()
+                    if self._is_filter_reachable(filter_data))
+
+    def _build_pipeline(self, filter_exec_list, prune=True):
+        """
+        :param prune: False for lists that must run whatever their phases
+                      (e.g. reverse executions of the filters)
+        :return: True if any filter was added in front of the backend
+        """
+        if prune:
+            filter_exec_list = self._prune_filter_execution_list(
+                filter_exec_list)
+        if not filter_exec_list:
+            # Straight to the backend
+            return False
+        self.request_log.pipeline(self.account, filter_exec_list)
+        with self.request_log.timed('build'):
+            self._build_pipeline_apps(filter_exec_list)
+        return True
+
+    def _build_filter(self, app, filter_type):
+        if filter_type == 'storlet' and STORLETS:
+            return StorletFilter(app, self.conf)
+        elif filter_type == 'native':
+            return self._load_native_filter(app, self.conf)
+        return app
+
+    def _reads_backend_fd(self, filter_exec_list):
+        """
+        True if the first filter of an object server GET is a storlet: the
+        storlet gateway then reads the object file descriptor directly, so
+        nothing may wrap the backend response
+        """
+        if self.method != 'get' or self.server != 'object' or \
+           not filter_exec_list:
+            return False
+        return filter_exec_list[max(filter_exec_list)]['type'] == 'storlet'
+
+    def _is_prefetch_enabled(self, filter_exec_list):
+        """
+        Read-ahead between the backend and the first filter of a GET, if
+        enabled in the configuration or by any of the filters
+        """
+        if self.method != 'get' or not filter_exec_list or \
+           self._reads_backend_fd(filter_exec_list):
+            return False
+        return self.conf.get('prefetch_enabled') or \
+            any(filter_exec_list[key].get('prefetch')
+                for key in filter_exec_list)
+
+    def _build_pipeline_apps(self, filter_exec_list):
         app = self.app
+        recorder = self.conf.get('placement_recorder')
+        metered = recorder and self.method in ('get', 'put')
+
+        if self._is_prefetch_enabled(filter_exec_list):
+            app = PrefetchPoint(app, self.conf['prefetch_depth'],
+                                self.conf.get('prefetch_stats'))
+        backend_fd_key = None
+        if self._reads_backend_fd(filter_exec_list):
+            backend_fd_key = max(filter_exec_list)
 
         for key in sorted(filter_exec_list, reverse=True):
             filter_data = filter_exec_list[key]
             filter_type = filter_data['type']
             self.conf['filter_data'] = filter_data
 
-            if filter_type == 'storlet' and STORLETS:
-                app = StorletFilter(app, self.conf)
-            elif filter_type == 'native':
-                app = self._load_native_filter(app, self.conf)
+            if self.admission:
+                self.admission_tickets.append(
+                    self.admission.acquire(self.account, filter_data['name']))
+
+            if metered and filter_data.get('movable') and \
+               key != backend_fd_key:
+                # Measure data ratio and cost to feed the placement engine
+                measurement = Measurement(filter_data['name'], self.method,
+                                          recorder)
+                app = MeterPoint(app, measurement, 'inner')
+                app = self._build_filter(app, filter_type)
+                app = MeterPoint(app, measurement, 'outer')
+            else:
+                app = self._build_filter(app, filter_type)
+
+            if self.conf.get('rechunk_enabled') and self.method == 'get':
+                app = RechunkPoint(app, self.conf['rechunk_size'],
+                                   self.conf['rechunk_max_size'],
+                                   self.conf.get('rechunk_histogram'),
+                                   filter_data['name'])
 
         self.app = app
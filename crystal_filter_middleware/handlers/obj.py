@@ -1,4 +1,5 @@
 from crystal_filter_middleware.handlers import CrystalBaseHandler
+from crystal_filter_middleware.common.request_log import log_debug
 from swift.common.swob import HTTPMethodNotAllowed
 from swift.common.utils import public
 import json
@@ -24,7 +25,7 @@ class CrystalObjectHandler(CrystalBaseHandler):
                 return HTTPMethodNotAllowed(request=self.request)
             return handler()
         else:
-            self.logger.info('Request disabled for Crystal')
+            log_debug(self.logger, 'Request disabled for Crystal')
             return self.request.get_response(self.app)
 
     def _augment_filter_execution_list(self, filter_list):
@@ -35,6 +36,8 @@ class CrystalObjectHandler(CrystalBaseHandler):
             for key in reversed(sorted(filter_list)):
                 launch_key = len(new_filter_list.keys())
                 new_filter_list[launch_key] = filter_list[key]
+                # Not metered: they would count as forward GET samples
+                new_filter_list[launch_key]['movable'] = False
 
         # Get filter list to execute from proxy server
         if 'crystal.filters' in self.request.headers:
@@ -50,21 +53,22 @@ class CrystalObjectHandler(CrystalBaseHandler):
         """
         GET handler on Object
         """
-        response = self.request.get_response(self.app)
+        with self.request_log.timed('backend'):
+            response = self.request.get_response(self.app)
 
         if response.is_success:
             filter_list = None
             if 'X-Object-Sysmeta-Crystal' in response.headers:
                 filter_list = eval(response.headers.pop('X-Object-Sysmeta-Crystal'))
             filter_exec_list = self._augment_filter_execution_list(filter_list)
-            if filter_exec_list:
-                self.logger.info('There are Filters to execute')
-                self.logger.info(str(filter_exec_list))
-                self._build_pipeline(filter_exec_list)
-                response = self.request.get_response(self.app)
-                response.headers.pop('X-Object-Sysmeta-Crystal')
-            else:
-                self.logger.info('No Filters to execute')
+            # Reverse executions of the PUT filters are not pruned by their
+            # (forward) phases, and the proxy already pruned its list
+            if self._build_pipeline(filter_exec_list, prune=False):
+                if hasattr(response.app_iter, 'close'):
+                    response.app_iter.close()
+                with self.request_log.timed('app'):
+                    response = self.request.get_response(self.app)
+                response.headers.pop('X-Object-Sysmeta-Crystal', None)
 
         return response
 
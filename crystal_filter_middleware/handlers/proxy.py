@@ -1,8 +1,14 @@
 from crystal_filter_middleware.handlers import CrystalBaseHandler
+from crystal_filter_middleware.common.request_log import log_debug
+from crystal_filter_middleware.common.breaker import CircuitOpen
+from crystal_filter_middleware.common.admission import AdmittedInput
 from swift.common.swob import HTTPMethodNotAllowed
+from swift.common.swob import HTTPServiceUnavailable
 from swift.common.wsgi import make_subrequest
 from swift.common.utils import public
+from swift.common.utils import config_true_value
 import operator
+import redis
 import json
 import copy
 import urllib
@@ -13,6 +19,11 @@ mappings = {'>': operator.gt, '>=': operator.ge,
             '==': operator.eq, '<=': operator.le, '<': operator.lt,
             '!=': operator.ne, "OR": operator.or_, "AND": operator.and_}
 
+# Headers that make a HEAD answer depend on the request rather than on the
+# object: not sent on the HEAD that reads the metadata for the conditions
+HEAD_EXCLUDED_HEADERS = ('if-match', 'if-none-match', 'if-modified-since',
+                         'if-unmodified-since', 'range')
+
 
 class CrystalProxyHandler(CrystalBaseHandler):
 
@@ -21,14 +32,108 @@ class CrystalProxyHandler(CrystalBaseHandler):
                                                   app, logger)
         self.etag = None
         self.filter_exec_list = None
+        self.object_metadata = None
+        self.conditional_filters = False
+        self.placements = dict()
+
+    def _evalsha_pipeline(self, args):
+        """
+        Runs the Lua script of filter_factory, through the circuit breaker
+        if enabled
+        """
+        lua_sha = self.conf.get('LUA_get_pipeline_sha')
+        breaker = self.conf.get('redis_breaker')
+        if breaker is None:
+            return self.redis.evalsha(lua_sha, 0, *args)
+        return breaker.call(self.redis.evalsha, lua_sha, 0, *args)
+
+    def _read_pipeline(self, args):
+        """
+        Concurrent reads of the same pipeline share a single Redis call
+        """
+        singleflight = self.conf.get('singleflight')
+        if singleflight:
+            return singleflight.do('pipeline', args,
+                                   self._evalsha_pipeline, args)
+        return self._evalsha_pipeline(args)
+
+    def _get_pipeline_redis_list(self, args):
+        """
+        Reads the pipeline from the node's shared policy cache or, on a miss,
+        from Redis through the circuit breaker. If Redis is unavailable, the
+        last-known-good pipeline of (account, container) is served instead.
+        """
+        last_known_good = self.conf.get('redis_last_known_good')
+        policy_cache = self.conf.get('policy_cache')
+        if policy_cache:
+            redis_list = policy_cache.get_pipeline(*args)
+            if redis_list is not None:
+                if last_known_good is not None:
+                    # Still served if Redis fails once the table is stale
+                    last_known_good.set(args, redis_list)
+                return redis_list
+
+        if last_known_good is None:
+            return self._read_pipeline(args)
+
+        try:
+            redis_list = self._read_pipeline(args)
+            last_known_good.set(args, redis_list)
+            return redis_list
+        except (CircuitOpen, redis.RedisError) as e:
+            entry = last_known_good.get(args)
+            if entry is None:
+                return self._unavailable_pipeline(args, e, ())
+
+            age, redis_list = entry
+            max_age = self.conf['redis_last_known_good_max_age']
+            if max_age and age > max_age:
+                # Too old to be trusted
+                return self._unavailable_pipeline(args, e, redis_list)
+            return redis_list
+
+    def _unavailable_pipeline(self, args, error, redis_list):
+        """
+        Pipeline to run when the policies of (account, container) cannot be
+        read: no filters if the failure policy is open, or a 503. Filters
+        of redis_list (the stale pipeline) without their own failure_policy
+        follow redis_failure_policy.
+        """
+        default_policy = self.conf.get('redis_failure_policy', 'closed')
+        policies = set([default_policy])
+        if redis_list:
+            index = redis_list.index('@@@@')
+            filters = redis_list[1:index:2] + redis_list[index+2::2]
+            policies = set(json.loads(metadata).get('failure_policy',
+                                                    default_policy)
+                           for metadata in filters) or policies
+        if 'closed' in policies:
+            raise HTTPServiceUnavailable(request=self.request)
+        self.logger.warning('Policies of %s/%s unavailable (%r), running '
+                            'without filters', args[0], args[1], error)
+        return ['@@@@']
 
     def _get_dynamic_filters(self):
+        batch_cache = self.conf.get('batch_cache')
+        batch_key = None
+        if batch_cache:
+            batch_key = batch_cache.get_key(self.request.environ, self.account,
+                                            self.container, self.method)
+        entry = batch_cache.get(batch_key) if batch_key else None
+        if entry and entry[1] is not None:
+            # Same bulk operation and no per-object conditions
+            self.proxy_filter_exec_list, self.object_filter_exec_list = \
+                copy.deepcopy(entry[1])
+            return
+
         # Dynamic binding of policies: using a Lua script that executes
         # a hgetall on the first matching key of a list and also returns
         # the global filters
-        lua_sha = self.conf.get('LUA_get_pipeline_sha')
         args = (self.account.replace('AUTH_', ''), '' if self.container is None else self.container)
-        redis_list = self.redis.evalsha(lua_sha, 0, *args)
+        if entry:
+            redis_list = entry[0]
+        else:
+            redis_list = self._get_pipeline_redis_list(args)
         index = redis_list.index("@@@@")  # Separator between pipeline and global filters
 
         self.filter_list = dict(zip(redis_list[0:index:2], redis_list[1:index:2]))
@@ -41,6 +146,13 @@ class CrystalProxyHandler(CrystalBaseHandler):
             self.proxy_filter_exec_list = self._build_filter_execution_list('proxy')
             self.object_filter_exec_list = self._build_filter_execution_list('object')
 
+        if batch_key:
+            exec_lists = None
+            if not self.conditional_filters:
+                exec_lists = copy.deepcopy((self.proxy_filter_exec_list,
+                                            self.object_filter_exec_list))
+            batch_cache.set(batch_key, (redis_list, exec_lists))
+
     def _parse_vaco(self):
         return self.request.split_path(2, 4, rest_with_last=True)
 
@@ -48,16 +160,46 @@ class CrystalProxyHandler(CrystalBaseHandler):
 
         if self.is_crystal_valid_request and hasattr(self, self.request.method):
             try:
-                self._get_dynamic_filters()
+                with self.request_log.timed('policy'):
+                    self._get_dynamic_filters()
                 handler = getattr(self, self.request.method)
                 getattr(handler, 'publicly_accessible')
             except AttributeError:
                 return HTTPMethodNotAllowed(request=self.request)
+            if self.admission and self.obj and \
+               (self.proxy_filter_exec_list or self.object_filter_exec_list):
+                self._admit()
             return handler()
         else:
-            self.logger.info('Request disabled for Crystal')
+            log_debug(self.logger, 'Request disabled for Crystal')
             return self.request.get_response(self.app)
 
+    def _admit(self):
+        """
+        Admits the filtered request within the budgets of its account, and
+        throttles its request body to the byte budget. Only the proxy admits
+        requests: object servers only limit the filters they run.
+        """
+        self.admission_tickets.append(self.admission.acquire(self.account))
+        if 'wsgi.input' in self.request.environ:
+            self.request.environ['wsgi.input'] = AdmittedInput(
+                self.request.environ['wsgi.input'], self.admission,
+                self.account)
+
+    def _head_object(self):
+        """
+        Object metadata, required to check the filter conditions
+        """
+        headers = dict((key, value)
+                       for key, value in self.request.headers.items()
+                       if key.lower() not in HEAD_EXCLUDED_HEADERS)
+        sub_req = make_subrequest(self.request.environ, method='HEAD',
+                                  path=self.request.path_info,
+                                  headers=headers,
+                                  swift_source='Crystal Filter Middleware')
+        resp = sub_req.get_response(self.app)
+        return resp.headers
+
     def _check_conditions(self, filter_metadata):
         """
         This method ckecks the object_tag, object_type and object_size parameters
@@ -68,17 +210,26 @@ class CrystalProxyHandler(CrystalBaseHandler):
            not filter_metadata['object_size']:
             return True
 
+        self.conditional_filters = True
         metadata = {}
         if self.method == 'put':
             for key in self.request.headers.keys():
                 metadata[key.lower()] = self.request.headers.get(key)
         else:
-            sub_req = make_subrequest(self.request.environ, method='HEAD',
-                                      path=self.request.path_info,
-                                      headers=self.request.headers,
-                                      swift_source='Crystal Filter Middleware')
-            resp = sub_req.get_response(self.app)
-            metadata = resp.headers
+            if self.object_metadata is None:
+                singleflight = self.conf.get('singleflight')
+                if singleflight:
+                    # Only requests with the same identity share the answer
+                    key = (self.request.path_info,
+                           self.request.headers.get('X-Auth-Token'),
+                           self.request.headers.get('X-Service-Token'),
+                           self.request.environ.get('REMOTE_USER'),
+                           self.request.headers.get('X-Newest'))
+                    self.object_metadata = singleflight.do(
+                        'head', key, self._head_object)
+                else:
+                    self.object_metadata = self._head_object()
+            metadata = self.object_metadata
 
         correct_type = True
         correct_size = True
@@ -130,6 +281,11 @@ class CrystalProxyHandler(CrystalBaseHandler):
         filter_dep = filter_metadata["dependencies"]
         filter_size = filter_metadata["content_length"]
         reverse = filter_metadata["reverse"]
+        movable = config_true_value(filter_metadata.get("movable", False))
+        prefetch = config_true_value(filter_metadata.get("prefetch", False))
+        phases = filter_metadata.get("phases")
+        if phases and not isinstance(phases, list):
+            phases = [x.strip() for x in phases.split(',') if x.strip()]
 
         filter_data = {'name': filter_name,
                        'language': language,
@@ -138,10 +294,46 @@ class CrystalProxyHandler(CrystalBaseHandler):
                        'type': filter_type,
                        'main': filter_main,
                        'dependencies': filter_dep,
-                       'size': filter_size}
+                       'size': filter_size,
+                       'movable': movable,
+                       'prefetch': prefetch,
+                       'phases': phases}
 
         return filter_data
 
+    def _get_execution_server(self, filter_metadata):
+        """
+        Returns the server where the filter must run. Movable filters are
+        placed by the placement engine (if enabled) from measured data.
+        """
+        placement_engine = self.conf.get('placement_engine')
+        if placement_engine and \
+           config_true_value(filter_metadata.get('movable', False)):
+            # Decided once per request, for both execution lists
+            key = (filter_metadata['filter_name'],
+                   filter_metadata['execution_order'])
+            if key not in self.placements:
+                self.placements[key] = placement_engine.place(
+                    filter_metadata, self.method)
+            return self.placements[key]
+        return filter_metadata['execution_server']
+
+    def _get_filter_data(self, filter_metadata, server):
+        """
+        Returns the parsed filter if it must run on server for this request,
+        or None. Filters that cannot affect this method are discarded before
+        their conditions are checked, to avoid the HEAD of the object.
+        """
+        if self.method not in filter_metadata or \
+           not filter_metadata[self.method] or \
+           self._get_execution_server(filter_metadata) != server:
+            return None
+        filter_data = self._parse_filter_metadata(filter_metadata)
+        if not self._is_filter_reachable(filter_data) or \
+           not self._check_conditions(filter_metadata):
+            return None
+        return filter_data
+
     def _build_filter_execution_list(self, server):
         """
         This method builds the filter execution list (ordered).
@@ -151,20 +343,16 @@ class CrystalProxyHandler(CrystalBaseHandler):
         ''' Parse global filters '''
         for _, filter_metadata in self.global_filters.items():
             filter_metadata = json.loads(filter_metadata)
-            if self.method in filter_metadata and filter_metadata[self.method] \
-               and filter_metadata['execution_server'] == server \
-               and self._check_conditions(filter_metadata):
-                filter_data = self._parse_filter_metadata(filter_metadata)
+            filter_data = self._get_filter_data(filter_metadata, server)
+            if filter_data:
                 order = filter_metadata["execution_order"]
                 filter_execution_list[int(order)] = filter_data
 
         ''' Parse Project specific filters'''
         for _, filter_metadata in self.filter_list.items():
             filter_metadata = json.loads(filter_metadata)
-            if self.method in filter_metadata and filter_metadata[self.method] \
-               and filter_metadata['execution_server'] == server \
-               and self._check_conditions(filter_metadata):
-                filter_data = self._parse_filter_metadata(filter_metadata)
+            filter_data = self._get_filter_data(filter_metadata, server)
+            if filter_data:
                 order = filter_metadata["execution_order"]
 
                 filter_execution_list[order] = filter_data
@@ -211,6 +399,16 @@ class CrystalProxyHandler(CrystalBaseHandler):
         if crystal_md:
             self.request.headers['X-Object-Sysmeta-Crystal'] = crystal_md
 
+    def _set_object_server_filters(self):
+        """
+        Sends to the object server the filters it has to execute
+        """
+        object_filter_exec_list = self._prune_filter_execution_list(
+            self.object_filter_exec_list)
+        if object_filter_exec_list:
+            object_server_filters = json.dumps(object_filter_exec_list)
+            self.request.headers['crystal.filters'] = object_server_filters
+
     def _save_size_and_etag(self):
         """
         Save original object Size and Etag
@@ -295,17 +493,12 @@ class CrystalProxyHandler(CrystalBaseHandler):
         Handle HTTP GET or HEAD requests.
         """
         if self.proxy_filter_exec_list:
-            self.logger.info('There are Filters to execute')
-            self.logger.info(str(self.proxy_filter_exec_list))
             self._build_pipeline(self.proxy_filter_exec_list)
-        else:
-            self.logger.info('No Filters to execute')
 
-        if self.object_filter_exec_list:
-            object_server_filters = json.dumps(self.object_filter_exec_list)
-            self.request.headers['crystal.filters'] = object_server_filters
+        self._set_object_server_filters()
 
-        response = self.request.get_response(self.app)
+        with self.request_log.timed('app'):
+            response = self.request.get_response(self.app)
         self._recover_size_and_etag(response)
 
         return response
@@ -316,17 +509,11 @@ class CrystalProxyHandler(CrystalBaseHandler):
         Handle HTTP PUT requests.
         """
         if self.proxy_filter_exec_list:
-            self.logger.info('There are Filters to execute')
-            self.logger.info(str(self.proxy_filter_exec_list))
             self._set_crystal_metadata()
             self._save_size_and_etag()
             self._build_pipeline(self.proxy_filter_exec_list)
-        else:
-            self.logger.info('No filters to execute')
 
-        if self.object_filter_exec_list:
-            object_server_filters = json.dumps(self.object_filter_exec_list)
-            self.request.headers['crystal.filters'] = object_server_filters
+        self._set_object_server_filters()
 
         return self.request.get_response(self.app)
 
@@ -336,14 +523,8 @@ class CrystalProxyHandler(CrystalBaseHandler):
         Handle HTTP POST or DELETE requests.
         """
         if self.proxy_filter_exec_list:
-            self.logger.info('There are Filters to execute')
-            self.logger.info(str(self.proxy_filter_exec_list))
             self._build_pipeline(self.proxy_filter_exec_list)
-        else:
-            self.logger.info('No filters to execute')
 
-        if self.object_filter_exec_list:
-            object_server_filters = json.dumps(self.object_filter_exec_list)
-            self.request.headers['crystal.filters'] = object_server_filters
+        self._set_object_server_filters()
 
         return self.request.get_response(self.app)
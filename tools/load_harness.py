@@ -0,0 +1,768 @@
+'''
+Concurrent end-to-end load harness for the Crystal filter middleware.
+
+Runs, on a single box, real eventlet WSGI workers (forked, sharing the
+listen socket like Swift does) with the pipeline:
+
+    crystal_filters (proxy) -> fake proxy -> crystal_filters (object)
+        -> fake object server (temp files)
+
+against a local Redis stand-in that speaks the Redis protocol (served from
+its own forked process), and a stub storlet gateway (the storlet and mixed
+shapes require the storlets package). A
+configurable workload is replayed with a pool of concurrent clients, and
+throughput, p50/p95/p99 latencies and per-worker memory growth are
+reported.
+
+Example:
+
+    python tools/load_harness.py --workers 4 --concurrency 64 \\
+        --duration 60 --mix get=70,put=20,head=5,delete=5 \\
+        --sizes 4096=5,65536=4,1048576=1 --shapes none,native,native2 \\
+        --conf rechunk_enabled=true
+'''
+import argparse
+import hashlib
+import json
+import math
+import os
+import random
+import shutil
+import signal
+import sys
+import tempfile
+import time
+
+import eventlet
+eventlet.monkey_patch()
+
+from eventlet import wsgi  # noqa
+try:
+    from eventlet.green import httplib  # noqa
+except ImportError:
+    from eventlet.green.http import client as httplib  # noqa
+
+from swift.common.swob import HTTPCreated  # noqa
+from swift.common.swob import HTTPAccepted  # noqa
+from swift.common.swob import HTTPNoContent  # noqa
+from swift.common.swob import HTTPNotFound  # noqa
+from swift.common.swob import Request  # noqa
+from swift.common.swob import Response  # noqa
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..'))
+from crystal_filter_middleware import crystal_filter_handler  # noqa
+
+CHUNK_SIZE = 65536
+
+
+"""
+Redis stand-in
+"""
+
+
+class FakeRedisServer(object):
+    """
+    Minimal Redis server (RESP protocol) with the commands used by the
+    middleware. EVALSHA of any loaded script runs the pipeline lookup of
+    the Lua script registered in filter_factory.
+    """
+
+    def __init__(self):
+        self.hashes = dict()
+        self.values = dict()
+        self.scripts = set()
+        self.sock = eventlet.listen(('127.0.0.1', 0))
+        self.port = self.sock.getsockname()[1]
+
+    def start(self):
+        """
+        Serves from a child process, so that the workers forked later do
+        not inherit the server greenthread and its data
+        """
+        pid = os.fork()
+        if pid == 0:
+            try:
+                while True:
+                    conn, _ = self.sock.accept()
+                    eventlet.spawn(self._handle, conn)
+            finally:
+                os._exit(0)
+        self.sock.close()
+        return pid
+
+    # RESP encoding/decoding
+
+    @staticmethod
+    def _read_command(rfile):
+        line = rfile.readline()
+        if not line:
+            return None
+        if not line.startswith(b'*'):
+            return line.strip().split()
+        args = []
+        for _ in range(int(line[1:])):
+            length = int(rfile.readline()[1:])
+            args.append(rfile.read(length + 2)[:-2])
+        return args
+
+    def _encode(self, value):
+        if isinstance(value, Exception):
+            return b'-' + str(value).encode('utf-8') + b'\r\n'
+        if value is True:
+            return b'+OK\r\n'
+        if value is None:
+            return b'$-1\r\n'
+        if isinstance(value, int):
+            return b':%d\r\n' % value
+        if isinstance(value, (list, tuple)):
+            return b'*%d\r\n' % len(value) + \
+                b''.join(self._encode(v) for v in value)
+        if not isinstance(value, bytes):
+            value = str(value).encode('utf-8')
+        return b'$%d\r\n%s\r\n' % (len(value), value)
+
+    def _handle(self, conn):
+        rfile = conn.makefile('rb')
+        queued = None
+        try:
+            while True:
+                args = self._read_command(rfile)
+                if args is None:
+                    break
+                name = args[0].upper().decode('utf-8')
+                if name == 'MULTI':
+                    queued = []
+                    reply = b'+OK\r\n'
+                elif name == 'EXEC':
+                    reply = self._encode([self._run(c[0].upper().decode(
+                        'utf-8'), c[1:]) for c in queued or []])
+                    queued = None
+                elif queued is not None:
+                    queued.append(args)
+                    reply = b'+QUEUED\r\n'
+                else:
+                    reply = self._encode(self._run(name, args[1:]))
+                conn.sendall(reply)
+        finally:
+            conn.close()
+
+    # Commands
+
+    def _run(self, name, args):
+        command = getattr(self, 'cmd_' + name.lower(), None)
+        if command is None:
+            if name in ('CLIENT', 'SELECT'):
+                return True
+            return Exception('ERR unknown command ' + name)
+        try:
+            return command(*args)
+        except Exception as e:
+            return Exception('ERR %s' % e)
+
+    def cmd_ping(self, *args):
+        return b'PONG'
+
+    def cmd_script(self, subcommand, script):
+        sha = hashlib.sha1(script).hexdigest()
+        self.scripts.add(sha.encode('utf-8'))
+        return sha
+
+    def cmd_evalsha(self, sha, numkeys, *args):
+        if sha not in self.scripts:
+            return Exception('NOSCRIPT No matching script')
+        account, container = args[0], args[1]
+        result = []
+        for key in (b'pipeline:' + account + b':' + container,
+                    b'pipeline:' + account):
+            if key in self.hashes:
+                for item in self.hashes[key].items():
+                    result.extend(item)
+                break
+        result.append(b'@@@@')
+        for item in self.hashes.get(b'pipeline:global', {}).items():
+            result.extend(item)
+        return result
+
+    def cmd_hset(self, key, *args):
+        hash_ = self.hashes.setdefault(key, dict())
+        for field, value in zip(args[0::2], args[1::2]):
+            hash_[field] = value
+        return len(args) // 2
+
+    def cmd_hgetall(self, key):
+        result = []
+        for item in self.hashes.get(key, {}).items():
+            result.extend(item)
+        return result
+
+    def cmd_hvals(self, key):
+        return list(self.hashes.get(key, {}).values())
+
+    def cmd_hincrbyfloat(self, key, field, increment):
+        hash_ = self.hashes.setdefault(key, dict())
+        value = float(hash_.get(field, 0)) + float(increment)
+        hash_[field] = repr(value).encode('utf-8')
+        return hash_[field]
+
+    def cmd_scan(self, cursor, *args):
+        options = dict(zip([a.upper() for a in args[0::2]], args[1::2]))
+        prefix = options.get(b'MATCH', b'*').rstrip(b'*')
+        keys = [k for k in list(self.hashes) + list(self.values)
+                if k.startswith(prefix)]
+        return [b'0', keys]
+
+    def cmd_zadd(self, key, score, member):
+        zset = self.hashes.setdefault(key, dict())
+        new = member not in zset
+        zset[member] = float(score)
+        return int(new)
+
+    def cmd_zrem(self, key, member):
+        return int(self.hashes.get(key, {}).pop(member, None) is not None)
+
+    def cmd_zcard(self, key):
+        return len(self.hashes.get(key, {}))
+
+    def cmd_zremrangebyscore(self, key, low, high):
+        zset = self.hashes.get(key, {})
+        low = float('-inf') if low == b'-inf' else float(low)
+        removed = [member for member, score in zset.items()
+                   if low <= score <= float(high)]
+        for member in removed:
+            del zset[member]
+        return len(removed)
+
+    def cmd_incr(self, key):
+        self.values[key] = int(self.values.get(key, 0)) + 1
+        return self.values[key]
+
+    def cmd_decr(self, key):
+        self.values[key] = int(self.values.get(key, 0)) - 1
+        return self.values[key]
+
+    def cmd_expire(self, key, seconds):
+        return 1
+
+
+"""
+Fake Swift servers
+"""
+
+
+class FakeObjectServer(object):
+    """
+    Object server storing data and metadata in temporary files, so that
+    all the workers see the same objects
+    """
+
+    def __init__(self, root):
+        self.root = root
+
+    def _paths(self, req):
+        _, _, account, container, obj = req.split_path(5, 5, True)
+        name = hashlib.md5(('%s/%s/%s' % (account, container, obj))
+                           .encode('utf-8')).hexdigest()
+        path = os.path.join(self.root, name)
+        return path + '.data', path + '.meta'
+
+    @staticmethod
+    def _read_body(wsgi_input):
+        if hasattr(wsgi_input, 'read'):
+            return iter(lambda: wsgi_input.read(CHUNK_SIZE), b'')
+        return wsgi_input
+
+    @staticmethod
+    def _file_iter(path):
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+                yield chunk
+
+    def __call__(self, env, start_response):
+        req = Request(env)
+        data_path, meta_path = self._paths(req)
+
+        if req.method == 'PUT':
+            etag = hashlib.md5()
+            size = 0
+            with open(data_path + '.tmp', 'wb') as f:
+                for chunk in self._read_body(env['wsgi.input']):
+                    etag.update(chunk)
+                    size += len(chunk)
+                    f.write(chunk)
+            os.rename(data_path + '.tmp', data_path)
+            metadata = dict((k, v) for k, v in req.headers.items()
+                            if k.lower().startswith(('x-object-meta-',
+                                                     'x-object-sysmeta-',
+                                                     'content-type')))
+            metadata.update({'Content-Length': str(size),
+                             'ETag': etag.hexdigest()})
+            with open(meta_path, 'w') as f:
+                json.dump(metadata, f)
+            return HTTPCreated(etag=etag.hexdigest())(env, start_response)
+
+        if not os.path.exists(meta_path):
+            return HTTPNotFound()(env, start_response)
+        with open(meta_path) as f:
+            metadata = json.load(f)
+
+        if req.method == 'DELETE':
+            for path in (data_path, meta_path):
+                os.unlink(path)
+            return HTTPNoContent()(env, start_response)
+
+        if req.method == 'POST':
+            metadata = dict((k, v) for k, v in metadata.items()
+                            if not k.lower().startswith('x-object-meta-'))
+            metadata.update((k, v) for k, v in req.headers.items()
+                            if k.lower().startswith('x-object-meta-'))
+            with open(meta_path, 'w') as f:
+                json.dump(metadata, f)
+            return HTTPAccepted()(env, start_response)
+
+        resp = Response(request=req, headers=metadata)
+        if req.method == 'GET':
+            resp.app_iter = self._file_iter(data_path)
+            resp.content_length = int(metadata['Content-Length'])
+        return resp(env, start_response)
+
+
+class FakeProxyApp(object):
+    """
+    Proxy app that answers account/container requests itself and sends the
+    object requests through the object server pipeline
+    """
+
+    def __init__(self, object_app):
+        self.object_app = object_app
+
+    def __call__(self, env, start_response):
+        req = Request(env)
+        _, account, container, obj = req.split_path(2, 4, True)
+        if not obj:
+            headers = {}
+            if not container:
+                headers['X-Account-Meta-Crystal-Enabled'] = 'True'
+            return HTTPNoContent(headers=headers)(env, start_response)
+        env['PATH_INFO'] = '/sda1/0/%s/%s/%s' % (account, container, obj)
+        return self.object_app(env, start_response)
+
+
+"""
+Stub storlet gateway and native filters
+"""
+
+
+class StubStorletRequest(object):
+
+    def __init__(self, storlet_id, params, user_metadata, data_iter=None,
+                 data_fd=None, options=None):
+        if data_fd is not None:
+            data_iter = iter(lambda: os.read(data_fd, CHUNK_SIZE), b'')
+        self.data_iter = data_iter
+
+
+class StubStorletData(object):
+    """
+    Output of the stub storlet: the input, usable as iterator or file
+    """
+
+    def __init__(self, data_iter):
+        self.iterator = iter(data_iter)
+        self.buffer = b''
+
+    def __iter__(self):
+        return self.iterator
+
+    def read(self, size=-1):
+        while size < 0 or len(self.buffer) < size:
+            try:
+                self.buffer += next(self.iterator)
+            except StopIteration:
+                break
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+class StubStorletResponse(object):
+
+    def __init__(self, data_iter):
+        self.data_iter = StubStorletData(data_iter)
+
+
+class StubStorletGateway(object):
+    request_class = StubStorletRequest
+
+    def __init__(self, conf, logger, scope):
+        pass
+
+    def invocation_flow(self, sreq):
+        return StubStorletResponse(sreq.data_iter)
+
+
+NATIVE_FILTER = '''
+from swift.common.swob import wsgify
+
+
+class HarnessFilter(object):
+    """
+    Native filter of the load harness: passes the bodies through in
+    chunks of the configured size
+    """
+
+    def __init__(self, app, conf):
+        self.app = app
+        self.chunk_size = int(conf['filter_data']['params'].get(
+            'chunk_size', 65536))
+
+    def _rechunk(self, app_iter):
+        buf = b''
+        for chunk in app_iter:
+            buf += chunk
+            while len(buf) >= self.chunk_size:
+                yield buf[:self.chunk_size]
+                buf = buf[self.chunk_size:]
+        if buf:
+            yield buf
+
+    @wsgify
+    def __call__(self, req):
+        resp = req.get_response(self.app)
+        if req.method == 'GET' and resp.is_success:
+            resp.app_iter = self._rechunk(resp.app_iter)
+        return resp
+'''
+
+
+def filter_metadata(name, filter_type, server, order, params=''):
+    return json.dumps({
+        'filter_name': name, 'language': 'python' if filter_type == 'native'
+        else 'java', 'params': params, 'filter_type': filter_type,
+        'main': 'HarnessFilter' if filter_type == 'native' else name,
+        'dependencies': '', 'content_length': '0', 'reverse': 'False',
+        'execution_server': server, 'execution_order': order,
+        'object_type': '', 'object_tag': '', 'object_size': '',
+        'object_name': '', 'get': True, 'put': True, 'head': True,
+        'post': True, 'delete': True})
+
+
+# Pipeline shapes: filters of each tenant (name, type, server)
+SHAPES = {
+    'none': [],
+    'native': [('harness_filter.py', 'native', 'proxy')],
+    'native2': [('harness_filter.py', 'native', 'proxy'),
+                ('harness_filter.py', 'native', 'object')],
+    'tiny_chunks': [('harness_filter.py', 'native', 'object',
+                     'chunk_size=512')],
+    'storlet': [('harness-1.0.jar', 'storlet', 'proxy')],
+    'mixed': [('harness_filter.py', 'native', 'proxy'),
+              ('harness-1.0.jar', 'storlet', 'object')],
+}
+
+
+def load_shapes(redis_server, shapes):
+    for shape in shapes:
+        pipeline = dict()
+        for order, spec in enumerate(SHAPES[shape]):
+            name, filter_type, server = spec[:3]
+            params = spec[3] if len(spec) > 3 else ''
+            pipeline[str(order).encode('utf-8')] = filter_metadata(
+                name, filter_type, server, order, params).encode('utf-8')
+        key = ('pipeline:%s' % shape).encode('utf-8')
+        redis_server.hashes[key] = pipeline
+
+
+"""
+Workers
+"""
+
+
+def build_app(conf, object_root):
+    common = dict(conf)
+    common['storlet_gateway_conf'] = os.devnull
+
+    object_conf = dict(common, execution_server='object')
+    object_factory = crystal_filter_handler.filter_factory({}, **object_conf)
+    proxy_conf = dict(common, execution_server='proxy')
+    proxy_factory = crystal_filter_handler.filter_factory({}, **proxy_conf)
+
+    object_mw = object_factory(FakeObjectServer(object_root))
+    proxy_mw = proxy_factory(FakeProxyApp(object_mw))
+    if crystal_filter_handler.STORLETS:
+        for mw in (object_mw, proxy_mw):
+            mw.conf['storlets_gateway_module'] = StubStorletGateway
+    return proxy_mw
+
+
+def rss_bytes():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+
+
+def run_worker(sock, conf, object_root, stats_dir):
+    app = build_app(conf, object_root)
+    stats_path = os.path.join(stats_dir, 'worker-%d.json' % os.getpid())
+    start_rss = rss_bytes()
+
+    def report_memory():
+        while True:
+            with open(stats_path, 'w') as f:
+                json.dump({'start_rss': start_rss, 'rss': rss_bytes()}, f)
+            eventlet.sleep(1)
+
+    eventlet.spawn(report_memory)
+    wsgi.server(sock, app, log_output=False, max_size=100000,
+                log=open(os.devnull, 'w'))
+
+
+"""
+Load generation
+"""
+
+
+def parse_weights(value, cast=str):
+    weights = []
+    for item in value.split(','):
+        key, _, weight = item.partition('=')
+        weights.append((cast(key.strip()), float(weight or 1)))
+    return weights
+
+
+def weighted_choice(weights):
+    total = sum(w for _, w in weights)
+    point = random.uniform(0, total)
+    for key, weight in weights:
+        point -= weight
+        if point <= 0:
+            return key
+    return weights[-1][0]
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    # Nearest-rank method
+    index = int(math.ceil(fraction * len(sorted_values))) - 1
+    return sorted_values[min(max(index, 0), len(sorted_values) - 1)]
+
+
+class LoadGenerator(object):
+
+    def __init__(self, port, args):
+        self.port = port
+        self.args = args
+        self.mix = parse_weights(args.mix)
+        self.sizes = parse_weights(args.sizes, int)
+        self.shapes = args.shapes.split(',')
+        self.bodies = dict((size, os.urandom(size)) for size, _ in self.sizes)
+        self.latencies = dict()
+        self.statuses = dict()
+        # Objects written by finished PUTs, available to DELETE
+        self.scratch = dict((shape, []) for shape in self.shapes)
+        self.skipped = 0
+
+    def request(self, method, path, body=None):
+        conn = httplib.HTTPConnection('127.0.0.1', self.port,
+                                      timeout=self.args.timeout)
+        headers = {'X-Auth-Token': 'harness'}
+        if body is not None:
+            headers['Content-Length'] = str(len(body))
+        start = time.time()
+        try:
+            conn.request(method, path, body, headers)
+            resp = conn.getresponse()
+            while resp.read(CHUNK_SIZE):
+                pass
+            status = resp.status
+        except Exception:
+            status = 'error'
+        finally:
+            conn.close()
+        return status, time.time() - start
+
+    def populate(self):
+        pool = eventlet.GreenPool(self.args.concurrency)
+        for shape in self.shapes:
+            for i in range(self.args.objects):
+                size = weighted_choice(self.sizes)
+                pool.spawn_n(self.request, 'PUT',
+                             '/v1/AUTH_%s/harness/obj-%d' % (shape, i),
+                             self.bodies[size])
+        pool.waitall()
+
+    def one_request(self):
+        """
+        :return: False if the request was skipped
+        """
+        method = weighted_choice(self.mix).upper()
+        shape = random.choice(self.shapes)
+        base = '/v1/AUTH_%s/harness/' % shape
+        body = None
+        if method == 'PUT':
+            name = 'scratch-%d' % random.randint(0, 1 << 30)
+            body = self.bodies[weighted_choice(self.sizes)]
+        elif method == 'DELETE':
+            if not self.scratch[shape]:
+                # Only objects written by finished PUTs are deleted, so
+                # that GET and HEAD keep finding the populated ones
+                self.skipped += 1
+                return False
+            name = self.scratch[shape].pop(
+                random.randrange(len(self.scratch[shape])))
+        else:
+            name = 'obj-%d' % random.randrange(self.args.objects)
+
+        status, elapsed = self.request(method, base + name, body)
+        if method == 'PUT' and status == 201:
+            self.scratch[shape].append(name)
+        key = (method, shape)
+        self.latencies.setdefault(key, []).append(elapsed)
+        self.statuses.setdefault(key, dict())
+        self.statuses[key][status] = self.statuses[key].get(status, 0) + 1
+        return True
+
+    def run(self):
+        deadline = time.time() + self.args.duration
+        pool = eventlet.GreenPool(self.args.concurrency)
+        done = [0]
+
+        def client():
+            while time.time() < deadline and \
+                    (not self.args.requests or done[0] < self.args.requests):
+                if self.one_request():
+                    done[0] += 1
+                else:
+                    eventlet.sleep(0)
+
+        start = time.time()
+        for _ in range(self.args.concurrency):
+            pool.spawn_n(client)
+        pool.waitall()
+        return time.time() - start
+
+
+def report(generator, elapsed, stats_dir, as_json):
+    rows = []
+    total = 0
+    for key in sorted(generator.latencies):
+        values = sorted(generator.latencies[key])
+        total += len(values)
+        rows.append({'method': key[0], 'shape': key[1],
+                     'requests': len(values),
+                     'throughput': len(values) / elapsed,
+                     'p50': percentile(values, 0.50),
+                     'p95': percentile(values, 0.95),
+                     'p99': percentile(values, 0.99),
+                     'statuses': dict((str(k), v) for k, v in
+                                      generator.statuses[key].items())})
+    workers = []
+    for name in sorted(os.listdir(stats_dir)):
+        with open(os.path.join(stats_dir, name)) as f:
+            stats = json.load(f)
+        workers.append({'worker': name[7:-5], 'start_rss': stats['start_rss'],
+                        'rss': stats['rss'],
+                        'growth': stats['rss'] - stats['start_rss']})
+
+    result = {'elapsed': elapsed, 'requests': total,
+              'throughput': total / elapsed, 'operations': rows,
+              'skipped_deletes': generator.skipped, 'workers': workers}
+    if as_json:
+        print(json.dumps(result, indent=2))
+        return
+
+    print('%d requests in %.1fs: %.1f req/s (%d DELETEs skipped, no '
+          'object to delete)' % (total, elapsed, total / elapsed,
+                                 generator.skipped))
+    print('%-7s %-12s %8s %9s %9s %9s %9s  %s' % (
+        'method', 'shape', 'requests', 'req/s', 'p50 ms', 'p95 ms',
+        'p99 ms', 'statuses'))
+    for row in rows:
+        print('%-7s %-12s %8d %9.1f %9.2f %9.2f %9.2f  %s' % (
+            row['method'], row['shape'], row['requests'], row['throughput'],
+            row['p50'] * 1000, row['p95'] * 1000, row['p99'] * 1000,
+            ' '.join('%s:%d' % s for s in sorted(row['statuses'].items()))))
+    print('%-8s %12s %12s %12s' % ('worker', 'start RSS', 'end RSS',
+                                   'growth'))
+    for worker in workers:
+        print('%-8s %12d %12d %12d' % (worker['worker'], worker['start_rss'],
+                                       worker['rss'], worker['growth']))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--concurrency', type=int, default=32)
+    parser.add_argument('--duration', type=float, default=30,
+                        help='seconds of load')
+    parser.add_argument('--requests', type=int, default=0,
+                        help='stop after this many requests (0: no limit)')
+    parser.add_argument('--objects', type=int, default=50,
+                        help='objects created per shape before the load')
+    parser.add_argument('--mix', default='get=70,put=20,head=5,delete=5',
+                        help='method weights')
+    parser.add_argument('--sizes', default='4096=5,65536=4,1048576=1',
+                        help='object size weights, in bytes')
+    parser.add_argument('--shapes', default='none,native,native2',
+                        help='pipeline shapes, one tenant each: %s' %
+                        ','.join(sorted(SHAPES)))
+    parser.add_argument('--conf', action='append', default=[],
+                        help='middleware option key=value (repeatable)')
+    parser.add_argument('--log-level', default='WARNING')
+    parser.add_argument('--timeout', type=float, default=30)
+    parser.add_argument('--json', action='store_true')
+    args = parser.parse_args()
+
+    for shape in args.shapes.split(','):
+        if shape not in SHAPES:
+            parser.error('unknown shape %s' % shape)
+        storlet = any(spec[1] == 'storlet' for spec in SHAPES[shape])
+        if storlet and not crystal_filter_handler.STORLETS:
+            # The middleware would silently skip the storlet filters
+            parser.error('shape %s requires the storlets package' % shape)
+
+    workdir = tempfile.mkdtemp(prefix='crystal-harness-')
+    object_root = os.path.join(workdir, 'objects')
+    filters_dir = os.path.join(workdir, 'native_filters')
+    stats_dir = os.path.join(workdir, 'stats')
+    for path in (object_root, filters_dir, stats_dir):
+        os.mkdir(path)
+    with open(os.path.join(filters_dir, 'harness_filter.py'), 'w') as f:
+        f.write(NATIVE_FILTER)
+
+    redis_server = FakeRedisServer()
+    load_shapes(redis_server, args.shapes.split(','))
+    children = [redis_server.start()]
+
+    conf = {'redis_host': '127.0.0.1', 'redis_port': str(redis_server.port),
+            'native_filters_path': filters_dir, 'log_level': args.log_level,
+            'workers': str(args.workers)}
+    conf.update(item.split('=', 1) for item in args.conf)
+
+    sock = eventlet.listen(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    try:
+        for _ in range(args.workers):
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    run_worker(sock, conf, object_root, stats_dir)
+                finally:
+                    os._exit(0)
+            children.append(pid)
+
+        generator = LoadGenerator(port, args)
+        generator.populate()
+        elapsed = generator.run()
+        eventlet.sleep(1.1)
+        report(generator, elapsed, stats_dir, args.json)
+    finally:
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+            os.waitpid(pid, 0)
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()